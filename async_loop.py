@@ -0,0 +1,279 @@
+from PyQt4.QtCore import QObject, QTimer, QEventLoop, QSocketNotifier
+from PyQt4.QtGui import QApplication
+import functools
+import math
+import sys
+import time
+import numpy as np
+try:
+    import asyncio
+    import selectors
+except ImportError:
+    asyncio = None
+
+
+if asyncio is not None:
+    class NotifyingSelector(selectors.DefaultSelector):
+        """Selector telling an AsyncioBridge which file descriptors the loop waits on"""
+        def __init__(self, bridge):
+            super(NotifyingSelector, self).__init__()
+            self.bridge = bridge
+
+        def register(self, fileobj, events, data=None):
+            key = super(NotifyingSelector, self).register(fileobj, events, data)
+            self.bridge.selector_changed = True
+            return key
+
+        def modify(self, fileobj, events, data=None):
+            key = super(NotifyingSelector, self).modify(fileobj, events, data)
+            self.bridge.selector_changed = True
+            return key
+
+        def unregister(self, fileobj):
+            key = super(NotifyingSelector, self).unregister(fileobj)
+            self.bridge.forget(key.fd)
+            return key
+
+    class BridgedEventLoop(asyncio.SelectorEventLoop):
+        """Selector event loop waking an AsyncioBridge when callbacks are added from Qt slots"""
+        def __init__(self, bridge):
+            self.bridge = bridge
+            self.selector = NotifyingSelector(bridge)
+            super(BridgedEventLoop, self).__init__(self.selector)
+
+        def call_soon(self, *args, **kwargs):
+            handle = super(BridgedEventLoop, self).call_soon(*args, **kwargs)
+            self.bridge.wake()
+            return handle
+
+        def call_at(self, *args, **kwargs):
+            handle = super(BridgedEventLoop, self).call_at(*args, **kwargs)
+            self.bridge.wake()
+            return handle
+
+        def next_timeout(self):
+            """ms until a callback is due, None if the loop only waits for sockets.
+            asyncio has no public way to tell, so this is the one place reading
+            its internals: _ready holds the callbacks due now and _scheduled the
+            timer heap."""
+            if self._ready:
+                return 0
+            if self._scheduled:
+                return max(0, int(math.ceil((self._scheduled[0].when() - self.time()) * 1000)))
+            return None
+
+
+class AsyncioBridge(QObject):
+    """Runs an asyncio event loop inside the Qt event loop, so coroutines and slots share the GUI thread.
+    A BridgedEventLoop only runs when a socket it waits on is ready or its next callback is due;
+    any other loop given is run every poll_interval."""
+    # ms between runs of a loop given to the bridge, e.g. the Windows proactor
+    poll_interval = 10
+
+    def __init__(self, loop=None, parent=None):
+        super(AsyncioBridge, self).__init__(parent)
+        self.stepping = False
+        self.notifiers = {}
+        self.selector_changed = True
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.step)
+        self.loop = loop or BridgedEventLoop(self)
+        asyncio.set_event_loop(self.loop)
+        self.timer.start(0)
+
+    def wake(self):
+        if not self.stepping:
+            self.timer.start(0)
+
+    def forget(self, fd):
+        """Drop the notifiers of an unregistered file descriptor at once, as its number may be reused"""
+        for k in [k for k in self.notifiers if k[0] == fd]:
+            notifier = self.notifiers.pop(k)
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+        self.selector_changed = True
+
+    def step(self):
+        if self.stepping or self.loop.is_closed():
+            # E.g. a socket became ready inside a nested Qt event loop started by a callback
+            return
+        self.stepping = True
+        try:
+            self.loop.call_soon(self.loop.stop)
+            self.loop.run_forever()
+        finally:
+            self.stepping = False
+        if not isinstance(self.loop, BridgedEventLoop):
+            self.timer.start(self.poll_interval)
+            return
+        if self.selector_changed:
+            self.selector_changed = False
+            self.watch(self.loop.selector)
+        timeout = self.loop.next_timeout()
+        if timeout is None:
+            self.timer.stop()
+        else:
+            self.timer.start(timeout)
+
+    def watch(self, selector):
+        """Keep one QSocketNotifier per file descriptor and event the loop waits on"""
+        wanted = set()
+        for key in selector.get_map().values():
+            if key.events & selectors.EVENT_READ:
+                wanted.add((key.fd, QSocketNotifier.Read))
+            if key.events & selectors.EVENT_WRITE:
+                wanted.add((key.fd, QSocketNotifier.Write))
+        for k in set(self.notifiers) - wanted:
+            notifier = self.notifiers.pop(k)
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+        for k in wanted - set(self.notifiers):
+            notifier = self.notifiers[k] = QSocketNotifier(k[0], k[1], self)
+            notifier.activated.connect(self.socket_ready)
+
+    def socket_ready(self, fd):
+        # One run of the loop on the next pass serves all ready sockets, instead of
+        # a run per socket ahead of Qt's own events
+        if not (self.timer.isActive() and self.timer.interval() == 0):
+            self.timer.start(0)
+
+    def close(self):
+        self.timer.stop()
+        for notifier in self.notifiers.values():
+            notifier.setEnabled(False)
+        self.notifiers = {}
+        self.loop.close()
+
+
+_bridge = None
+
+
+def install_asyncio(loop=None):
+    """Start running an asyncio loop from the Qt event loop, returning it"""
+    global _bridge
+    if asyncio is None:
+        raise RuntimeError('asyncio is not available in this Python version')
+    if _bridge is None:
+        _bridge = AsyncioBridge(loop)
+    return _bridge.loop
+
+
+def report_task_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        error = task.exception()
+        sys.excepthook(type(error), error, error.__traceback__)
+
+
+def schedule(coro):
+    """Run a coroutine on the installed loop, e.g. from a slot. Errors go to sys.excepthook."""
+    task = asyncio.ensure_future(coro, loop=install_asyncio())
+    task.add_done_callback(report_task_error)
+    return task
+
+
+def coroutine_slot(fn):
+    """Make a coroutine function usable as a slot: calling it schedules the coroutine"""
+    @functools.wraps(fn)
+    def slot(*args, **kwargs):
+        return schedule(fn(*args, **kwargs))
+    return slot
+
+
+def wait_signal(signal, timeout=None):
+    """Future for the arguments of the next emission of a Qt signal (a single
+    argument on its own), failing with asyncio.TimeoutError after timeout seconds"""
+    loop = install_asyncio()
+    future = loop.create_future()
+    def emitted(*args):
+        signal.disconnect(emitted)
+        if not future.done():
+            future.set_result(args[0] if len(args) == 1 else args)
+    def expired():
+        if not future.done():
+            signal.disconnect(emitted)
+            future.set_exception(asyncio.TimeoutError())
+    signal.connect(emitted)
+    if timeout is not None:
+        loop.call_later(timeout, expired)
+    return future
+
+
+class GeneratorCoroutine(object):
+    """Awaitable running a generator as a coroutine, e.g. for schedule. Python 2 parses neither
+    async def nor yield from, so the generator waits on a future by yielding from its __await__()."""
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __await__(self):
+        return self.generator
+
+
+def benchmark_latency(tasks=2000, connections=100, duration=3., interval=10):
+    """Lateness in ms of a Qt timer (mean, 99th percentile, max) and requests answered per second
+    while `tasks` coroutines started with schedule each keep an echo request in flight, over
+    `connections` local sockets of the installed loop"""
+    app = QApplication.instance() or QApplication([])
+    loop = install_asyncio()
+    answered = [0]
+    # Reply future of each task by task number
+    waiting = {}
+
+    class Echo(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            self.transport.write(data)
+
+    class Client(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.buffer = b''
+
+        def data_received(self, data):
+            lines = (self.buffer + data).split(b'\n')
+            self.buffer = lines.pop()
+            for line in lines:
+                waiting.pop(int(line)).set_result(None)
+
+    def request(i, transport):
+        while True:
+            reply = waiting[i] = loop.create_future()
+            transport.write(str(i).encode() + b'\n')
+            for step in reply.__await__():
+                yield step
+            answered[0] += 1
+
+    server = loop.run_until_complete(loop.create_server(Echo, '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    clients = [loop.run_until_complete(loop.create_connection(Client, '127.0.0.1', port))[0]
+               for _ in range(connections)]
+    running = [schedule(GeneratorCoroutine(request(i, clients[i % connections]))) for i in range(tasks)]
+
+    ticks = []
+    timer = QTimer()
+    timer.timeout.connect(lambda: ticks.append(time.time()))
+    timer.start(interval)
+    wait = QEventLoop()
+    QTimer.singleShot(int(duration * 1000), wait.quit)
+    start = time.time()
+    wait.exec_()
+    elapsed = time.time() - start
+    timer.stop()
+
+    # Closed first, so that no reply arrives for a cancelled task
+    for transport in clients:
+        transport.close()
+    for task in running:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*running, return_exceptions=True))
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    late = np.maximum(np.diff(ticks) * 1000 - interval, 0) if len(ticks) > 1 else np.zeros(1)
+    return {'mean_ms': float(late.mean()), 'p99_ms': float(np.percentile(late, 99)),
+            'max_ms': float(late.max()), 'requests_per_s': answered[0] / elapsed}
+
+
+if __name__ == '__main__':
+    for name, value in sorted(benchmark_latency().items()):
+        print('%-16s %10.2f' % (name, value))
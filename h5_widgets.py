@@ -1,168 +1,1193 @@
-from PyQt4 import QtGui
+from PyQt4 import QtGui, QtCore
 from PyQt4.Qt import Qt
-import h5py
+from collections import defaultdict, OrderedDict
+import bisect
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from tasks import shared_executor, check_cancelled, Cancelled
+from lazy_import import LazyModule
+# Imported when a file is first read
+h5py = LazyModule('h5py')
 
+# Attributes set by h5py for axis handling
+HIDDEN_ATTRS = ('DIMENSION_SCALE', 'DIMENSION_LIST', 'CLASS', 'NAME', 'REFERENCE_LIST')
+# Attribute values with more elements are described instead of read
+MAX_ATTR_ELEMENTS = 1000
+# Longer attribute texts are cut short in the tree
+MAX_ATTR_CHARS = 200
+# Optional dataset columns after name and shape
+STAT_COLUMNS = ('dtype', 'Storage', 'Compression', 'Min', 'Max', 'Mean', 'NaNs')
 
-class H5File(QtGui.QStandardItemModel):
-    def __init__(self, file=None):
+
+def variant(value):
+    return QtCore.QVariant() if value is None else QtCore.QVariant(value)
+
+
+def join_name(parent_name, name):
+    return parent_name.rstrip('/') + '/' + name
+
+
+def describe(obj, name):
+    """Record describing one member row of the tree"""
+    record = {'name': name, 'junk': bool(obj.attrs.get('__JUNK__', False)), 'size': len(obj.attrs)}
+    if isinstance(obj, h5py.Group):
+        record['kind'] = 'group'
+        record['size'] += len(obj)
+    else:
+        record.update(kind='dataset', shape=list(obj.shape), dtype=str(obj.dtype))
+    return record
+
+
+def read_children(obj, attrs=True):
+    """Records for the attribute rows (first) and member rows below a group or dataset"""
+    records = []
+    if attrs:
+        for k in obj.attrs.keys():
+            if k not in HIDDEN_ATTRS:
+                records.append({'kind': 'attr', 'name': k})
+    if isinstance(obj, h5py.Group):
+        for k in obj.keys():
+            records.append(describe(obj[k], k))
+    return records
+
+
+def list_object(obj, attrs=True):
+    """Names of the shown attributes of obj (if attrs) and of its members, without reading any values"""
+    keys = [k for k in obj.attrs.keys() if k not in HIDDEN_ATTRS] if attrs else []
+    return keys, list(obj.keys()) if isinstance(obj, h5py.Group) else []
+
+
+def attr_text(value):
+    """Text for an attribute value and whether it is shown in full"""
+    text = str(value)
+    if len(text) > MAX_ATTR_CHARS:
+        return text[:MAX_ATTR_CHARS - 3] + '...', False
+    return text, True
+
+
+def read_attr_values(obj, keys=None):
+    """attr_text of the attributes of obj, reading only the small ones"""
+    attrs = obj.attrs
+    values = {}
+    for k in attrs.keys() if keys is None else keys:
+        if k in HIDDEN_ATTRS:
+            continue
+        try:
+            aid = attrs.get_id(k)
+        except KeyError:
+            continue
+        shape = aid.shape or ()
+        size = 1
+        for n in shape:
+            size *= n
+        if size > MAX_ATTR_ELEMENTS:
+            values[k] = '<%s array %s>' % (aid.dtype, ' x '.join(str(n) for n in shape)), False
+        else:
+            values[k] = attr_text(attrs[k])
+    return values
+
+
+def block_shape(shape, chunks, itemsize, block_bytes):
+    """Shape of whole chunks (or elements) of at most block_bytes, or of
+    one chunk if that is bigger, grown along the last axes first"""
+    unit = chunks or (1,) * len(shape)
+    block = list(unit)
+    for axis in reversed(range(len(shape))):
+        others = itemsize
+        for n in block[:axis] + block[axis + 1:]:
+            others *= n
+        block[axis] = min(shape[axis], max(1, block_bytes // (others * unit[axis])) * unit[axis])
+        if block[axis] < shape[axis]:
+            break
+    return tuple(block)
+
+
+def iter_blocks(dataset, block_bytes=2**24):
+    """Read a dataset in blocks of whole chunks of at most about block_bytes each"""
+    shape = dataset.shape
+    if not shape:
+        yield np.asarray(dataset[()])
+        return
+    if 0 in shape:
+        return
+    block = block_shape(shape, dataset.chunks, dataset.dtype.itemsize, block_bytes)
+    for start in itertools.product(*[range(0, n, b) for n, b in zip(shape, block)]):
+        yield dataset[tuple(slice(i, i + b) for i, b in zip(start, block))]
+
+
+def dataset_statistics(dataset, block_bytes=2**24):
+    """Storage and value statistics of a dataset, or None if it can't be read"""
+    try:
+        stats = {'storage': dataset.id.get_storage_size()}
+        if stats['storage']:
+            stats['compression'] = float(dataset.size * dataset.dtype.itemsize) / stats['storage']
+        if dataset.dtype.kind not in 'biuf':
+            return stats
+        lo = hi = None
+        total = 0.
+        count = nans = 0
+        for block in iter_blocks(dataset, block_bytes):
+            check_cancelled()
+            if block.dtype.kind == 'f':
+                nan = np.isnan(block)
+                nans += int(nan.sum())
+                block = block[~nan]
+            if block.size:
+                lo = block.min() if lo is None else min(lo, block.min())
+                hi = block.max() if hi is None else max(hi, block.max())
+                total += block.sum(dtype=np.float64)
+                count += block.size
+        stats['nans'] = nans
+        if count:
+            stats.update(min=lo, max=hi, mean=total / count)
+        return stats
+    except Cancelled:
+        raise
+    except Exception:
+        return None
+
+
+def format_bytes(n):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if n < 1024:
+            break
+        n /= 1024.
+    else:
+        unit = 'TB'
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (n, unit)
+
+
+def trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+class SearchIndex(object):
+    """Substring search over the full names of the rows read so far, by the trigrams of
+    each row's own name. Safe to search on a worker thread while rows are added."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = set()
+        self.grams = defaultdict(set)
+        self.generation = 0
+        self.last = {}
+
+    def add(self, items):
+        with self.lock:
+            self.generation += 1
+            for item in items:
+                item.indexed_at = self.generation
+                self.items.add(item)
+                for g in trigrams(item.name):
+                    self.grams[g].add(item)
+            self.last = {}
+
+    def remove(self, items):
+        """Remove rows along with their loaded descendants"""
+        with self.lock:
+            for item in items:
+                self.items.discard(item)
+                for g in trigrams(item.name):
+                    self.grams[g].discard(item)
+                    if not self.grams[g]:
+                        del self.grams[g]
+                self.remove(item.children or ())
+            self.last = {}
+
+    def rename(self, item, old_name):
+        with self.lock:
+            for g in trigrams(old_name) - trigrams(item.name):
+                self.grams[g].discard(item)
+            for g in trigrams(item.name):
+                self.grams[g].add(item)
+            self.last = {}
+
+    def with_descendants(self, items):
+        found = set()
+        stack = list(items)
+        while stack:
+            item = stack.pop()
+            if item not in found:
+                found.add(item)
+                stack.extend(item.children or ())
+        return found
+
+    def search_term(self, term):
+        refinable = [found for prev, found in self.last.items() if prev in term]
+        if refinable:
+            candidates = min(refinable, key=len)
+        else:
+            key = max(term.split('/'), key=len)
+            if not key:
+                candidates = self.items
+            elif len(key) < 3:
+                candidates = self.with_descendants(i for i in self.items if key in i.name)
+            else:
+                owners = set.intersection(*[self.grams.get(g, set()) for g in trigrams(key)])
+                candidates = self.with_descendants(i for i in owners if key in i.name)
+        return set(i for i in candidates if term in i.fullname and i in self.items)
+
+    def search(self, term_string):
+        """Rows whose full names contain every word of term_string"""
+        terms = str(term_string).split()
+        with self.lock:
+            if not terms:
+                return set(self.items)
+            found = dict((t, self.search_term(t)) for t in set(terms))
+            self.last = found
+            return set.intersection(*found.values())
+
+
+class ListedName(object):
+    """A name found by H5File.list_names, searchable before its row is read.
+    children stays None until the names below it have been listed."""
+    __slots__ = ('name', 'fullname', 'file_row', 'h5path', 'children', 'indexed_at')
+
+    def __init__(self, name, fullname, file_row=None, h5path=None):
+        self.name = name
+        self.fullname = fullname
+        # The row of the file holding the object, None for attributes
+        self.file_row = file_row
+        self.h5path = h5path
+        self.children = None if file_row is not None else []
+        self.indexed_at = 0
+
+
+class StructureCache(object):
+    """Records of the groups read from HDF5 files, kept on disk as one JSON file per HDF5 file.
+    An entry is dropped when its file's size or mtime changed; old entries are evicted."""
+    max_bytes = 64 * 2**20
+    max_age = 30 * 24 * 3600
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'pyqt-utils', 'h5')
+        self.directory = directory
+        self.entries = {}
+        # Absolute paths whose entries were checked against the file since the last check_files
+        self.checked = set()
+
+    def file_key(self, filename):
+        st = os.stat(filename)
+        return [os.path.abspath(filename), st.st_size, st.st_mtime]
+
+    def cache_path(self, filename):
+        path = os.path.abspath(filename)
+        digest = hashlib.sha1(path if isinstance(path, bytes) else path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def check_files(self):
+        """Compare entries with their files again on next use, e.g. when the files are reread"""
+        self.checked = set()
+
+    def entry(self, filename):
+        """The cached groups of filename, dropped if the file changed"""
+        entry = self.entries.get(os.path.abspath(filename))
+        if entry is not None and entry['key'][0] in self.checked:
+            return entry
+        try:
+            key = self.file_key(filename)
+        except OSError:
+            return {'key': None, 'groups': {}}
+        self.checked.add(key[0])
+        if entry is None or entry['key'] != key:
+            entry = None
+            try:
+                path = self.cache_path(filename)
+                with open(path) as f:
+                    entry = json.load(f)
+                os.utime(path, None)
+            except (IOError, OSError, ValueError):
+                pass
+            if entry is None or entry.get('key') != key:
+                entry = {'key': key, 'groups': {}}
+            self.entries[key[0]] = entry
+        return entry
+
+    def get(self, filename, name):
+        return self.entry(filename)['groups'].get(name)
+
+    def put(self, filename, name, records):
+        self.entry(filename)['groups'][name] = records
+
+    def save(self, filename):
+        entry = self.entry(filename)
+        if entry['key'] is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = self.cache_path(filename)
+            f = tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False)
+            with f:
+                json.dump(entry, f)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(f.name, path)
+        except (IOError, OSError, ValueError):
+            return
+        self.evict()
+
+    def evict(self):
+        try:
+            paths = [os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith('.json')]
+            stats = sorted((os.stat(p).st_mtime, os.stat(p).st_size, p) for p in paths)
+        except OSError:
+            return
+        total = sum(size for _, size, _ in stats)
+        oldest = time.time() - self.max_age
+        for mtime, size, path in stats:
+            if mtime >= oldest and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def in_use(f):
+    """Whether objects of an open file other than the file itself are open, such as
+    datasets held by plots or read by a worker thread"""
+    return h5py.h5f.get_obj_count(f.id, h5py.h5f.OBJ_ALL & ~h5py.h5f.OBJ_FILE) > 0
+
+
+class H5FilePool(object):
+    """Open h5py files shared by absolute path, closing the least recently used
+    beyond max_open. Files with objects in use are never closed but by reopen, so
+    max_open may be exceeded while they are; objects given up, like the file
+    itself, should be re-resolved through get when no longer valid. Taking an
+    object from a file returned by get should happen under lock, as another
+    thread may close it meanwhile."""
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, path, mode=None, swmr=False):
+        """An open file for path. mode None reuses a handle of any mode, or opens with h5py's default;
+        a read without swmr is served by a SWMR handle. Raises IOError if the open handle cannot
+        serve the request but is in use."""
+        key = os.path.abspath(path)
+        with self.lock:
+            entry = self.handles.pop(key, None)
+            if entry is not None:
+                f, f_mode, f_swmr = entry
+                if not f.id.valid:
+                    entry = None
+                elif (swmr and not f_swmr) or mode not in (None, 'r', f_mode):
+                    if in_use(f):
+                        self.handles[key] = entry
+                        raise IOError('%s is in use in another mode' % key)
+                    f.close()
+                    entry = None
+            if entry is None:
+                if swmr:
+                    f = h5py.File(key, 'r', libver='latest', swmr=True)
+                else:
+                    f = h5py.File(key, mode)
+                entry = f, mode, swmr
+            self.handles[key] = entry
+            excess = len(self.handles) - self.max_open
+            for old_key, (old, _, _) in list(self.handles.items())[:-1]:
+                if excess <= 0:
+                    break
+                if not old.id.valid or not in_use(old):
+                    del self.handles[old_key]
+                    if old.id.valid:
+                        old.close()
+                    excess -= 1
+            return entry[0]
+
+    def close(self, path):
+        with self.lock:
+            entry = self.handles.pop(os.path.abspath(path), None)
+            if entry is not None and entry[0].id.valid:
+                entry[0].close()
+
+    def reopen(self, path, mode=None, swmr=False):
+        """Close and open the file again, e.g. to see changes made by another process.
+        Objects taken from the old handle become invalid, even if in use."""
+        self.close(path)
+        return self.get(path, mode, swmr)
+
+    def close_all(self):
+        with self.lock:
+            for path in list(self.handles):
+                self.close(path)
+
+
+# Shared by the models and widgets of this module unless given their own
+file_pool = H5FilePool()
+
+
+class H5File(QtCore.QAbstractItemModel):
+    """Tree model of one or more HDF5 files whose rows are read only when expanded, optionally
+    built from a StructureCache and following a file written in SWMR mode."""
+    save_delay = 2000
+    headers = ('Name', 'Value') + STAT_COLUMNS
+    stats_visible = False
+    follow_interval = 1000
+    dataset_grown = QtCore.pyqtSignal(object, object, object)
+
+    def __init__(self, file=None, cache=None, pool=None):
         super(H5File, self).__init__()
+        self.file = None
+        self.root = None
+        self.multi = False
+        self.mode = None
+        self.cache = cache
+        self.cache_paths = set()
+        self.pool = pool or file_pool
+        self.stats_queue = []
+        self.stats_job = None
+        # Set by H5View: whether a row is on screen, so that rows scrolled away get no statistics,
+        # and the rows on screen, polled in follow mode along with the plotted ones
+        self.row_shown = None
+        self.shown_items = None
+        self.plotted = set()
+        # Names of everything in the file(s) by full name, listed one object at a time
+        # by searches; guarded by listing_lock as the GUI thread updates them on changes
+        self.listing_lock = threading.RLock()
+        self.listed = {}
+        self.unlisted = []
+        self.name_index = SearchIndex()
+        self.unvalidated = []
+        self.validate_timer = QtCore.QTimer(self)
+        self.validate_timer.setSingleShot(True)
+        self.validate_timer.timeout.connect(self.validate_next)
+        self.save_timer = QtCore.QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(self.save_delay)
+        self.save_timer.timeout.connect(self.save_cache)
+        self.swmr = False
+        self.follow_timer = QtCore.QTimer(self)
+        self.follow_timer.timeout.connect(self.poll)
         if file is not None:
             self.set_file(file)
 
     def set_file(self, file):
+        self.save_cache()
+        self.beginResetModel()
         self.file = file
-        self.clear()
-        self.setColumnCount(2)
-        for k in file.keys():
-            item = h5_dispatch(file[k])
-            self.invisibleRootItem().appendRow(item)
+        self.filename = file.filename
+        self.mode = file.mode
+        self.swmr = bool(getattr(file, 'swmr_mode', False))
+        self.multi = False
+        self.reset_tree(H5ItemName(self, None, {'kind': 'group', 'name': ''}))
+        self.root.path = os.path.abspath(self.filename)
+        self.root.children = self.root.load_children(attrs=False)
+        self.search_index.add(self.root.children)
+        self.listed['/'] = ListedName('', '/', self.root, '/')
+        self.unlisted.append(self.listed['/'])
+        self.endResetModel()
 
-    def refresh(self):
-        filename = self.file.filename
-        self.file.close()
-        self.set_file(h5py.File(filename))
+    def add_file(self, path):
+        """Show another file as a top level row. Files are opened through the pool
+        when their rows are expanded and may be closed again by it."""
+        if not self.multi:
+            self.save_cache()
+            self.beginResetModel()
+            self.file = None
+            self.multi = True
+            self.reset_tree(H5Item(self, None, {'kind': 'group', 'name': ''}))
+            self.root.children = []
+            self.endResetModel()
+        path = os.path.abspath(path)
+        row = H5FileRow(self, self.root, {'kind': 'file', 'name': os.path.basename(path), 'path': path, 'size': 1})
+        n = len(self.root.children)
+        self.beginInsertRows(QtCore.QModelIndex(), n, n)
+        self.root.children.append(row)
+        row.row_number = n
+        self.search_index.add([row])
+        # Its names are listed once the file is opened by expanding the row
+        self.list_later(row, read=False)
+        self.endInsertRows()
+        return row
 
+    def reset_tree(self, root):
+        self.unvalidated = []
+        self.reset_stats()
+        self.search_index = SearchIndex()
+        self.plotted = set()
+        with self.listing_lock:
+            self.listed, self.unlisted, self.name_index = {}, [], SearchIndex()
+        self.root = root
+        if self.cache is not None:
+            self.cache.check_files()
 
-def h5_dispatch(item):
-    if isinstance(item, h5py.Group):
-        return H5ItemName(item)
-    else:
-        return H5DatasetRow(item).columns
+    def open_file(self):
+        """The file of a single file model, reopened through the pool if it was closed"""
+        if not self.file.id.valid:
+            self.file = self.pool.get(self.filename, self.mode, self.swmr)
+        return self.file
 
+    def list_names(self):
+        """Read the names not listed yet into name_index, one object at a time so that
+        h5py is never held for long. Cancellable, the next call goes on where it stopped;
+        may run on a worker thread."""
+        while True:
+            check_cancelled()
+            with self.listing_lock:
+                if not self.unlisted:
+                    return
+                entry = self.unlisted[-1]
+                if entry.children is not None or self.listed.get(entry.fullname) is not entry:
+                    # Listed already, or dropped by a change to the tree
+                    self.unlisted.pop()
+                    continue
+            try:
+                with self.pool.lock:
+                    obj = entry.file_row.open_file()[entry.h5path]
+                keys, members = list_object(obj, entry.fullname != '/')
+            except KeyError:
+                # Removed from the file since it was listed
+                keys, members = [], []
+            with self.listing_lock:
+                if entry.children is not None or self.listed.get(entry.fullname) is not entry:
+                    continue
+                entry.children = [ListedName(k, join_name(entry.fullname, k)) for k in keys]
+                entry.children.extend(ListedName(k, join_name(entry.fullname, k), entry.file_row,
+                                                 join_name(entry.h5path, k)) for k in members)
+                for child in entry.children:
+                    self.listed[child.fullname] = child
+                self.name_index.add(entry.children)
+                self.unlisted.extend(entry.children[len(keys):])
 
-class H5Item(QtGui.QStandardItem):
-    def __init__(self, group, row=None, text=""):
-        super(H5Item, self).__init__(str(text))
-        self.group = group
-        self.row = row
-        self.fullname = group.name
-        self.name = group.name.split('/')[-1]
-        self.marked_junk = False
+    def list_later(self, item, read=True):
+        """Add a new or renamed row to the listing, to be read by list_names if read.
+        Skipped while its parent is not listed, as it is then listed along with it."""
+        with self.listing_lock:
+            entry = self.listed.get(item.fullname)
+            if entry is None:
+                parent = None
+                if not (self.multi and item._parent is self.root):
+                    parent = self.listed.get(item._parent.fullname)
+                    if parent is None or parent.children is None:
+                        return
+                    if item.is_attr:
+                        entry = ListedName(item.name, item.fullname)
+                if entry is None:
+                    entry = ListedName(item.name, item.fullname, item.file_row, item.h5path)
+                self.listed[entry.fullname] = entry
+                if parent is not None:
+                    parent.children.append(entry)
+                self.name_index.add([entry])
+            if read and entry.children is None:
+                self.unlisted.append(entry)
 
-        for k in group.attrs.keys():
-            if k in ('DIMENSION_SCALE', 'DIMENSION_LIST', 'CLASS', 'NAME', 'REFERENCE_LIST'):
-                # These are set by h5py for axis handling
-                continue
-            if k == "__JUNK__":
-                self.marked_junk = group.attrs[k]
-            self.appendRow(H5AttrRow(k, group).columns)
+    def forget_names(self, fullname):
+        """Drop a removed or renamed row and the names below it from the listing"""
+        with self.listing_lock:
+            entry = self.listed.pop(fullname, None)
+            if entry is None:
+                return
+            parent = self.listed.get(fullname.rsplit('/', 1)[0] or '/')
+            if parent is not None and entry in (parent.children or ()):
+                parent.children.remove(entry)
+            below = list(entry.children or ())
+            while below:
+                e = below.pop()
+                self.listed.pop(e.fullname, None)
+                below.extend(e.children or ())
+            self.name_index.remove([entry])
+
+    def read_records(self, item, attrs=True, cached=True):
+        """Child records of item, from the structure cache if possible"""
+        if self.cache is None:
+            return read_children(item.group, attrs)
+        path = item.file_row.path
+        records = self.cache.get(path, item.h5path) if cached else None
+        if records is not None:
+            self.unvalidated.append(item)
+            self.validate_timer.start()
+        else:
+            records = read_children(item.group)
+            self.cache.put(path, item.h5path, records)
+            self.cache_paths.add(path)
+            self.save_timer.start()
+        if not attrs:
+            records = [r for r in records if r['kind'] != 'attr']
+        return records
 
-        if isinstance(group, h5py.Group):
-            for k in group.keys():
-                items = h5_dispatch(group[k])
-                self.appendRow(items)
+    def validate_next(self):
+        """Check one group that was built from the cache against the file"""
+        while self.unvalidated:
+            item = self.unvalidated.pop(0)
+            if item is self.root or item in self.search_index.items:
+                item._group = None
+                self.merge_children(item, self.read_records(item, item is not self.root, cached=False))
+                break
+        if self.unvalidated:
+            self.validate_timer.start()
 
-    def data(self, role):
-        if role == Qt.BackgroundRole and self.row and self.row.plot is not None:
-            return QtGui.QBrush(QtGui.QColor(255, 0, 0, 127))
+    def set_stats_visible(self, visible):
+        """Show or hide the STAT_COLUMNS, computed in the background for rows as they are shown"""
+        if visible == self.stats_visible:
+            return
+        first, last = 2, 1 + len(STAT_COLUMNS)
+        if visible:
+            self.beginInsertColumns(QtCore.QModelIndex(), first, last)
+            self.stats_visible = True
+            self.endInsertColumns()
         else:
-            return super(H5Item, self).data(role)
+            self.reset_stats()
+            self.beginRemoveColumns(QtCore.QModelIndex(), first, last)
+            self.stats_visible = False
+            self.endRemoveColumns()
+
+    def request_stats(self, item):
+        if item not in self.stats_queue:
+            self.stats_queue.append(item)
+            self.next_stats()
+
+    def next_stats(self):
+        if self.row_shown is not None:
+            while self.stats_queue and not self.row_shown(self.stats_queue[-1]):
+                self.stats_queue.pop()
+        if self.stats_job is not None or not self.stats_queue:
+            return
+        # Most recently shown rows first
+        item = self.stats_queue[-1]
+        future = self.stats_job = shared_executor().submit(dataset_statistics, (item.group,), priority=-1)
+        def finished(stats):
+            self.stats_job = None
+            if item in self.stats_queue:
+                self.stats_queue.remove(item)
+            item.stats = stats or {}
+            self.item_changed(item)
+            self.next_stats()
+        def cancelled():
+            self.stats_job = None
+            self.next_stats()
+        future.finished.connect(finished)
+        future.cancelled.connect(cancelled)
+
+    def reset_stats(self):
+        """Forget queued statistics and stop the running computation"""
+        self.stats_queue = []
+        if self.stats_job is not None:
+            self.stats_job.cancel()
+
+    def save_cache(self):
+        self.save_timer.stop()
+        if self.cache is not None:
+            for path in self.cache_paths:
+                self.cache.save(path)
+        self.cache_paths = set()
+
+    def refresh(self):
+        """Reopen the file and update the rows that changed, keeping the rest of the tree and the view state"""
+        self.reset_stats()
+        if self.multi:
+            for row in self.root.children:
+                if row.children is not None:
+                    self.pool.reopen(row.path, self.mode, self.swmr)
+        else:
+            # A file given to set_file is left to its owner
+            self.file = self.pool.reopen(self.filename, self.mode, self.swmr)
+        if self.cache is not None:
+            self.cache.check_files()
+        self.update_structure()
+
+    def set_follow(self, follow, interval=None):
+        """Start or stop following the datasets of a file that is being written in SWMR mode.
+        A SWMR writer can only append to datasets, so groups and datasets created by the
+        writer outside of SWMR mode show up on refresh(). Raises if the file cannot be
+        opened in SWMR mode, leaving it open as before."""
+        if interval is not None:
+            self.follow_interval = interval
+        if follow:
+            if not self.swmr:
+                self.swmr = True
+                try:
+                    self.refresh()
+                except Exception as error:
+                    # E.g. not written with the latest file format
+                    self.swmr = False
+                    self.refresh()
+                    raise error
+            self.follow_timer.start(self.follow_interval)
+        else:
+            self.follow_timer.stop()
+
+    def poll(self):
+        """Pick up the growth of the datasets that are plotted, or on screen or expanded without a view"""
+        if self.shown_items is None:
+            items = self.plotted.union(i for i in self.iter_items() if i.children is not None)
+        else:
+            items = self.plotted.union(self.shown_items())
+        for item in items:
+            # Skipping rows removed from the tree since
+            if isinstance(item, H5DatasetRow) and item in self.search_index.items:
+                item.poll_shape()
+
+    def update_structure(self, item=None):
+        """Compare the loaded part of the tree against the file, inserting, removing
+        and updating only the rows that differ. Unexpanded rows are not read."""
+        item = item or self.root
+        if item is self.root and self.multi:
+            for row in item.children:
+                self.update_structure(row)
+            return
+        item._group = None
+        item.attr_values = None
+        if item.stats is not None:
+            item.stats = None
+            self.item_changed(item)
+        if item.children is None:
+            return
+        records = self.read_records(item, attrs=item is not self.root, cached=False)
+        self.merge_children(item, records)
+        attr_rows = sum(1 for c in item.children if c.is_attr)
+        if attr_rows:
+            parent = self.indexFromItem(item)
+            self.dataChanged.emit(self.index(0, 1, parent), self.index(attr_rows - 1, 1, parent))
+        for child in item.children:
+            self.update_structure(child)
+
+    def merge_children(self, item, records):
+        parent = self.indexFromItem(item)
+        by_key = dict(((r['kind'], r['name']), r) for r in records)
+        children = item.children
+
+        stale = [i for i, c in enumerate(children) if (c.record['kind'], c.name) not in by_key]
+        for start, stop in reversed(list(runs(stale))):
+            self.beginRemoveRows(parent, start, stop)
+            for child in children[start:stop + 1]:
+                self.forget_names(child.fullname)
+            self.search_index.remove(children[start:stop + 1])
+            del children[start:stop + 1]
+            item.renumber()
+            self.endRemoveRows()
+
+        for child in children:
+            if child.update(by_key[child.record['kind'], child.name]):
+                self.item_changed(child)
+                if child.children is None and not child.is_attr:
+                    # Members or attributes may have changed below a row that was never read
+                    self.forget_names(child.fullname)
+                    self.list_later(child)
+
+        present = set((c.record['kind'], c.name) for c in children)
+        missing = [i for i, r in enumerate(records) if (r['kind'], r['name']) not in present]
+        for start, stop in runs(missing):
+            self.beginInsertRows(parent, start, stop)
+            children[start:start] = [h5_dispatch(self, item, r) for r in records[start:stop + 1]]
+            self.search_index.add(children[start:stop + 1])
+            for child in children[start:stop + 1]:
+                self.list_later(child)
+            item.renumber()
+            self.endInsertRows()
+
+    def invisibleRootItem(self):
+        return self.root
+
+    def itemFromIndex(self, index):
+        return index.internalPointer() if index.isValid() else None
+
+    def indexFromItem(self, item, column=0):
+        if item is None or item is self.root:
+            return QtCore.QModelIndex()
+        return self.createIndex(item.row_number, column, item)
+
+    def iter_items(self, item=None):
+        """All rows read so far, depth first"""
+        for child in (item or self.root).children or ():
+            yield child
+            for descendant in self.iter_items(child):
+                yield descendant
+
+    def item_changed(self, item):
+        self.dataChanged.emit(self.indexFromItem(item, 0), self.indexFromItem(item, self.columnCount() - 1))
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+        node = self.itemFromIndex(parent) or self.root
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        return self.indexFromItem(index.internalPointer().parent())
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0 or self.root is None:
+            return 0
+        return len((self.itemFromIndex(parent) or self.root).children or ())
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.headers) if self.stats_visible else 2
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and section < self.columnCount():
+            return variant(self.headers[section])
+        return variant(None)
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0 or self.root is None:
+            return False
+        node = self.itemFromIndex(parent) or self.root
+        if node.children is not None:
+            return bool(node.children)
+        return node.has_children()
+
+    def canFetchMore(self, parent):
+        node = self.itemFromIndex(parent)
+        return node is not None and node.children is None and node.has_children()
+
+    def fetchMore(self, parent):
+        node = self.itemFromIndex(parent)
+        if node is None or node.children is not None:
+            return
+        children = node.load_children()
+        if not children:
+            # Only hidden attributes, so drop the expander
+            node.children = []
+            self.item_changed(node)
+            return
+        self.beginInsertRows(parent, 0, len(children) - 1)
+        node.children = children
+        self.search_index.add(children)
+        if isinstance(node, H5FileRow):
+            self.list_later(node)
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return variant(None)
+        return variant(index.internalPointer().data(index.column(), role))
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or not index.internalPointer().set_data(index.column(), value, role):
+            return False
+        self.item_changed(index.internalPointer())
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return index.internalPointer().flags(index.column())
+
+
+def runs(indices):
+    """(first, last) of each run of consecutive integers in a sorted list"""
+    start = prev = None
+    for i in indices:
+        if prev is None or i != prev + 1:
+            if start is not None:
+                yield start, prev
+            start = i
+        prev = i
+    if start is not None:
+        yield start, prev
+
+
+def h5_dispatch(model, parent, record):
+    kind = record['kind']
+    if kind == 'group':
+        return H5ItemName(model, parent, record)
+    elif kind == 'file':
+        return H5FileRow(model, parent, record)
+    elif kind == 'dataset':
+        return H5DatasetRow(model, parent, record)
+    return H5AttrItem(model, parent, record)
+
+
+class H5Item(object):
+    """A row of an H5File, created from a record and reading its own children on demand"""
+    is_attr = False
+    # The dataset row an item belongs to, as with the former per-column items
+    row = None
+
+    def __init__(self, model, parent, record):
+        self.model = model
+        self._parent = parent
+        self.record = record
+        self.name = record['name']
+        self.fullname = join_name(parent.fullname, self.name) if parent is not None else '/'
+        # The row holding the file this row is read from, and the part of fullname naming it
+        self.file_row = parent.file_row if parent is not None else self
+        self.file_prefix = ''
+        self.marked_junk = record.get('junk', False)
+        # Junk if marked itself or below a junk row, kept up to date by set_junk
+        self.junk = self.marked_junk or (parent is not None and parent.junk)
+        self.children = None
+        self.row_number = 0
+        self._group = None
+        # Texts of this row's attributes, read when the first is shown
+        self.attr_values = None
+        # dataset_statistics result, computed when shown
+        self.stats = None
+
+    @property
+    def group(self):
+        """The h5py object of this row, opened by name on first use"""
+        if self._group is None or not self._group.id.valid:
+            with self.model.pool.lock:
+                self._group = self.file_row.open_file()[self.h5path]
+        return self._group
+
+    @property
+    def h5path(self):
+        """Name of this row's object within its file"""
+        return self.fullname[len(self.file_row.file_prefix):] or '/'
+
+    def open_file(self):
+        return self.model.open_file()
+
+    def parent(self):
+        if self._parent is self.model.root:
+            return None
+        return self._parent
+
+    def child(self, row):
+        return self.children[row]
+
+    def has_children(self):
+        return self.record.get('size', 0) > 0
+
+    def attr_value(self, key):
+        if self.attr_values is None:
+            self.attr_values = read_attr_values(self.group)
+        if key not in self.attr_values:
+            self.attr_values.update(read_attr_values(self.group, [key]))
+        return self.attr_values.get(key, ('', False))
+
+    def load_children(self, attrs=True):
+        children = [h5_dispatch(self.model, self, r) for r in self.model.read_records(self, attrs)]
+        for i, child in enumerate(children):
+            child.row_number = i
+        return children
+
+    def renumber(self):
+        for i, child in enumerate(self.children):
+            child.row_number = i
+
+    def update(self, record):
+        """Take on a freshly read record, returning whether anything shown changed"""
+        changed = record != self.record
+        self.record = record
+        self.marked_junk = record.get('junk', False)
+        self.set_junk(self.marked_junk or (self._parent is not None and self._parent.junk))
+        return changed
+
+    def set_junk(self, junk):
+        if junk == self.junk:
+            return
+        self.junk = junk
+        for child in self.children or ():
+            child.set_junk(child.marked_junk or junk)
+
+    def column_text(self, column):
+        return self.name if column == 0 else ""
+
+    def data(self, column, role):
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.column_text(column)
+        return None
+
+    def set_data(self, column, value, role):
+        return False
+
+    def flags(self, column):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
 
     def is_junk(self):
-        p = self.parent()
-        if p is None:
-            return self.marked_junk
-        return self.marked_junk or p.is_junk()
+        return self.junk
 
 
 class H5ItemName(H5Item):
-    def __init__(self, group, row=None):
-        #name = group.name.split('/')[-1]
-        super(H5ItemName, self).__init__(group, row)
-        self.setText(str(self.name))
-
-    def setData(self, value, role):
-        if role != Qt.EditRole:
-            return super(H5ItemName, self).setData(value, role)
+    def set_data(self, column, value, role):
+        if column != 0 or role != Qt.EditRole:
+            return False
         v = value.toString()
         if v:
             self.set_name(v)
+        return True
 
     def set_name(self, name):
         name = str(name)
         if name == self.name:
             return
-        if self.parent() is None:
-            parent_group = self.group.file
-        else:
-            parent_group = self.parent().group
+        parent_group = self._parent.group
         parent_group[name] = self.group
-        self.group = parent_group[name]
+        self._group = parent_group[name]
         del parent_group[self.name]
-        self.name = name
-        self.setText(name)
-        self.emitDataChanged()
+        old_name, self.name = self.name, name
+        self.record['name'] = name
+        self.model.forget_names(self.fullname)
+        self.rename(join_name(self._parent.fullname, name))
+        self.model.search_index.rename(self, old_name)
+        self.model.list_later(self)
+        self.model.item_changed(self)
 
-    def flags(self):
-        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+    def rename(self, fullname):
+        self.fullname = fullname
+        for child in self.children or ():
+            child.rename(join_name(fullname, child.name))
 
+    def flags(self, column):
+        if column == 0:
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+        return super(H5ItemName, self).flags(column)
 
-class H5DatasetRow(object):
-    def __init__(self, dataset):
-        self.name = H5ItemName(dataset, self)
-        self.shape = H5Item(dataset, self, text=str(dataset.shape))
-        self.shape.setEditable(False)
-        self.plot = None
-        self.columns = [self.name, self.shape]
-
-class H5AttrItem(QtGui.QStandardItem):
-    def __init__(self, key, group, row, text=""):
-        super(H5AttrItem, self).__init__(text)
-        self.key = key
-        self.row = row
-        self.value = str(group.attrs[key])
-        self.fullname = group.name + '/' + key
-        self.name = key
-
-    def data(self, role):
-        if role == Qt.BackgroundRole:
-            return QtGui.QBrush(QtGui.QColor(0xed, 0xe6, 0xa4, 127))
+
+class H5FileRow(H5Item):
+    """Top level row of a multi-file H5File showing one file"""
+    def __init__(self, model, parent, record):
+        super(H5FileRow, self).__init__(model, parent, record)
+        self.path = record['path']
+        self.file_row = self
+        self.file_prefix = self.fullname
+
+    def open_file(self):
+        return self.model.pool.get(self.path, self.model.mode, self.model.swmr)
+
+    def column_text(self, column):
+        if column == 1:
+            return os.path.dirname(self.path)
+        return super(H5FileRow, self).column_text(column)
+
+
+class H5DatasetRow(H5ItemName):
+    _plot = None
+
+    @property
+    def row(self):
+        return self
+
+    @property
+    def plot(self):
+        """The plot showing the data, highlighting the row while set"""
+        return self._plot
+
+    @plot.setter
+    def plot(self, plot):
+        self._plot = plot
+        if plot is None:
+            self.model.plotted.discard(self)
         else:
-            return super(H5AttrItem, self).data(role)
+            self.model.plotted.add(self)
+        self.model.item_changed(self)
 
-    def flags(self):
-        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+    def poll_shape(self):
+        """Pick up data appended in SWMR mode, emitting dataset_grown if the shape changed"""
+        dataset = self.group
+        dataset.refresh()
+        old_shape, new_shape = tuple(self.record['shape']), dataset.shape
+        if new_shape != old_shape:
+            self.record = dict(self.record, shape=list(new_shape))
+            self.stats = None
+            self.model.item_changed(self)
+            self.model.dataset_grown.emit(self, old_shape, new_shape)
 
-    def is_junk(self):
-        return self.parent().is_junk()
+    def read_appended(self, old_shape):
+        """The data added along the first axis since the dataset had old_shape"""
+        return self.group[old_shape[0]:] if old_shape else self.group[()]
 
+    def set_plot(self, plot):
+        """Highlight the row while its data is shown in a plot"""
+        self.plot = plot
 
-class H5AttrKey(H5AttrItem):
-    def __init__(self, key, group, row):
-        super(H5AttrKey, self).__init__(key, group, row, text=str(key))
+    def column_text(self, column):
+        if column == 1:
+            return str(tuple(self.record['shape']))
+        if column >= 2:
+            return self.stat_text(STAT_COLUMNS[column - 2])
+        return super(H5DatasetRow, self).column_text(column)
 
-    def setData(self, value, role):
-        if role != Qt.EditRole:
-            return super(H5AttrKey, self).setData(value, role)
-        attr_val = self.group.attrs[self.key]
-        del self.group.attrs[self.key]
-        self.key = str(value.toString())
-        self.group.attrs[self.key] = attr_val
+    def stat_text(self, column):
+        if column == 'dtype':
+            return self.record['dtype']
+        if self.stats is None:
+            self.model.request_stats(self)
+            return '...'
+        if column == 'Storage':
+            return format_bytes(self.stats['storage']) if 'storage' in self.stats else ''
+        if column == 'Compression':
+            return '%.2f' % self.stats['compression'] if 'compression' in self.stats else ''
+        if column == 'NaNs':
+            return str(self.stats.get('nans', ''))
+        value = self.stats.get(column.lower())
+        return '' if value is None else '%.6g' % value
+
+    def data(self, column, role):
+        if role == Qt.BackgroundRole and self.plot is not None:
+            return QtGui.QBrush(QtGui.QColor(255, 0, 0, 127))
+        return super(H5DatasetRow, self).data(column, role)
+
+
+class H5AttrItem(H5Item):
+    is_attr = True
+
+    def __init__(self, model, parent, record):
+        super(H5AttrItem, self).__init__(model, parent, record)
+        self.key = self.name
 
+    @property
+    def group(self):
+        """The object holding the attribute"""
+        return self._parent.group
 
-class H5AttrValue(H5AttrItem):
-    def __init__(self, key, group, row):
-        #value = str(group.attrs[key])
-        super(H5AttrValue, self).__init__(key, group, row)
-        self.setText(self.value)
+    @property
+    def value(self):
+        return self._parent.attr_value(self.key)[0]
 
-    def setData(self, value, role):
+    def has_children(self):
+        return False
+
+    def column_text(self, column):
+        return self.key if column == 0 else self.value
+
+    def data(self, column, role):
+        if role == Qt.BackgroundRole:
+            return QtGui.QBrush(QtGui.QColor(0xed, 0xe6, 0xa4, 127))
+        return super(H5AttrItem, self).data(column, role)
+
+    def set_data(self, column, value, role):
         if role != Qt.EditRole:
-            return super(H5AttrValue, self).setData(value, role)
-        if value.canConvert(int):
-            v = value.toInt()
-        elif value.canConvert(float):
-            v = value.toFloat()
+            return False
+        attrs = self.group.attrs
+        if column == 0:
+            key = str(value.toString())
+            if not key or key == self.key:
+                return False
+            attr_val = attrs[self.key]
+            del attrs[self.key]
+            values = self._parent.attr_values or {}
+            if self.key in values:
+                values[key] = values.pop(self.key)
+            old_name = self.name
+            self.model.forget_names(self.fullname)
+            self.key = self.name = self.record['name'] = key
+            self.fullname = join_name(self._parent.fullname, key)
+            attrs[self.key] = attr_val
+            self.model.search_index.rename(self, old_name)
+            self.model.list_later(self)
         else:
             v = str(value.toString())
-        self.group.attrs[self.key] = v
+            for convert in (int, float):
+                try:
+                    v = convert(v)
+                    break
+                except ValueError:
+                    pass
+            attrs[self.key] = v
+            (self._parent.attr_values or {}).pop(self.key, None)
+        return True
 
-
-class H5AttrRow(object):
-    def __init__(self, key, dataset):
-        self.name = H5AttrKey(key, dataset, self)
-        self.value = H5AttrValue(key, dataset, self)
-        self.columns = [self.name, self.value]
+    def flags(self, column):
+        if column == 1 and not self._parent.attr_value(self.key)[1]:
+            # Editing a shortened value would overwrite the rest of it
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
 
 class H5View(QtGui.QTreeView):
     def __init__(self):
@@ -179,6 +1204,40 @@ class H5View(QtGui.QTreeView):
         collapse_action.triggered.connect(self.collapseAll)
         self.addAction(collapse_action)
 
+    def setModel(self, model):
+        super(H5View, self).setModel(model)
+        source = model.sourceModel() if isinstance(model, QtGui.QSortFilterProxyModel) else model
+        if isinstance(source, H5File):
+            source.row_shown = self.row_shown
+            source.shown_items = self.shown_items
+
+    def row_shown(self, item):
+        """Whether a row of the H5File is scrolled into view"""
+        model, index = self.model(), item.model.indexFromItem(item)
+        if isinstance(model, QtGui.QSortFilterProxyModel):
+            index = model.mapFromSource(index)
+        return index.isValid() and self.visualRect(index).intersects(self.viewport().rect())
+
+    def shown_items(self):
+        """The rows of the H5File scrolled into view, from the top"""
+        model = self.model()
+        index = self.indexAt(QtCore.QPoint(0, 0))
+        bottom = self.viewport().rect().bottom()
+        while index.isValid() and self.visualRect(index).top() <= bottom:
+            if isinstance(model, QtGui.QSortFilterProxyModel):
+                yield model.mapToSource(index).internalPointer()
+            else:
+                yield index.internalPointer()
+            index = self.indexBelow(index)
+
+    def selected_path(self):
+        """Full name of the current row, or None"""
+        model, index = self.model(), self.currentIndex()
+        if isinstance(model, QtGui.QSortFilterProxyModel):
+            model, index = model.sourceModel(), model.mapToSource(index)
+        item = model.itemFromIndex(index)
+        return None if item is None else item.fullname
+
 class TreeFilterModel(QtGui.QSortFilterProxyModel):
     def __init__(self, **kwargs):
         super(TreeFilterModel, self).__init__(**kwargs)
@@ -188,16 +1247,19 @@ class TreeFilterModel(QtGui.QSortFilterProxyModel):
         return self.sourceModel().itemFromIndex(self.mapToSource(idx))
 
     def set_matches(self, matches):
-        matches = set(matches)
-        old_matches = None
-        root = self.sourceModel().invisibleRootItem()
-        while matches != old_matches:
-            old_matches = matches
-            matches = matches.union({i.parent() for i in old_matches})
-            matches = matches.difference({None, root})
-        self.matching_items = matches
+        self.matching_items = self.closure(matches)
         self.invalidateFilter()
 
+    def closure(self, matches):
+        """The matches together with all of their ancestors"""
+        closed = set()
+        for item in matches:
+            # Stop at the first ancestor already added, its own ancestors are in too
+            while item is not None and item not in closed:
+                closed.add(item)
+                item = item.parent()
+        return closed
+
     def filterAcceptsRow(self, src_i, src_parent_index):
         this_parent = self.sourceModel().itemFromIndex(src_parent_index)
         if this_parent:
@@ -215,17 +1277,17 @@ class RecursiveFilterModel(TreeFilterModel):
     attrs_visible = False
     junk_visible = False
     term_string = ""
+    # Search index generation when the matches were last computed
+    match_generation = 0
+    # Sorted full names in the file matching the last search, loaded or not
+    hits = ()
 
     def setSourceModel(self, model):
         super(RecursiveFilterModel, self).setSourceModel(model)
         model.modelReset.connect(self.source_model_changed)
 
     def get_matches(self, t):
-        items = self.sourceModel().findItems("", Qt.MatchContains | Qt.MatchRecursive)
-        x = [i for i in items if t in i.fullname]
-        return x
-        #return [i for i in items if t in i.fullname]
-        #return self.sourceModel().findItems(t, Qt.MatchContains | Qt.MatchRecursive)
+        return self.sourceModel().search_index.search(t)
 
     def toggle_attrs_visible(self, checked):
         self.attrs_visible = checked
@@ -239,30 +1301,119 @@ class RecursiveFilterModel(TreeFilterModel):
         self.set_match_term(self.term_string)
 
     def set_match_term(self, term_string):
-        # Match all words
+        generation = self.sourceModel().search_index.generation
+        # On the GUI thread, so only the names listed so far are searched
+        _, matches, hits = self.compute_matches(term_string, list_names=False)
+        self.apply_matches(term_string, matches, generation, hits)
+
+    def search_names(self, term_string, list_names=True):
+        """Full names in the file containing all words, including rows not read yet.
+        With list_names, the names not listed yet are read first."""
+        if not str(term_string).split():
+            return []
+        model = self.sourceModel()
+        if list_names:
+            model.list_names()
+        return sorted(set(n.fullname for n in model.name_index.search(term_string)))
+
+    def compute_matches(self, term_string, list_names=True):
+        """Number of names matching all words, the loaded rows to show for them
+        and the sorted matching names. Does not touch the view, so it may run
+        on a worker thread."""
+        found = self.get_matches(term_string)
+        try:
+            hits = self.search_names(term_string, list_names)
+        except Cancelled:
+            raise
+        except Exception:
+            # E.g. the file was closed meanwhile, so only loaded rows are searched
+            hits = []
+        count = len(set(i.fullname for i in found).union(hits))
+        return count, self.closure(found), hits
+
+    def apply_matches(self, term_string, matches, generation, hits=()):
+        """Show the result of compute_matches, computed at the given search index generation"""
         self.term_string = term_string
-        matches = [set(self.get_matches(t)) for t in str(term_string).split()]
-        m0 = set(self.get_matches(""))
-        self.set_matches(m0.intersection(*matches))
+        self.match_generation = generation
+        self.matching_items = matches
+        self.hits = hits
+        self.invalidateFilter()
+
+    def leads_to_hit(self, fullname):
+        """Whether fullname or a name below it matched, so that rows not read
+        at search time stay visible and expandable down to the match"""
+        hits = self.hits
+        i = bisect.bisect_left(hits, fullname)
+        if i < len(hits) and hits[i] == fullname:
+            return True
+        i = bisect.bisect_left(hits, fullname + '/', i)
+        return i < len(hits) and hits[i].startswith(fullname + '/')
 
     def filter_accepts_item(self, item):
-        if not self.attrs_visible and isinstance(item, H5AttrItem):
+        if not self.attrs_visible and item.is_attr:
             return False
-        if not self.junk_visible and item.is_junk():
+        if not self.junk_visible and item.junk:
             return False
-        return super(RecursiveFilterModel, self).filter_accepts_item(item)
+        if item.indexed_at > self.match_generation:
+            # Read from the file after the last search, e.g. by expanding its parent
+            if all(t in item.fullname for t in str(self.term_string).split()):
+                return True
+        elif super(RecursiveFilterModel, self).filter_accepts_item(item):
+            return True
+        return self.leads_to_hit(item.fullname)
 
 class SearchableH5View(QtGui.QWidget):
+    """Tree view with a search box. Searching waits for a pause in typing and
+    runs off the GUI thread; only the result for the latest text is shown."""
+    search_delay = 200
+
     def __init__(self, model):
         super(SearchableH5View, self).__init__()
         layout = QtGui.QVBoxLayout(self)
-        match_model = RecursiveFilterModel()
+        match_model = self.match_model = RecursiveFilterModel()
         match_model.setSourceModel(model)
         match_model.set_match_term("")
         self.tree_view = H5View()
         self.tree_view.setModel(match_model)
+        stats_action = QtGui.QAction("Show Statistics", self.tree_view)
+        stats_action.setCheckable(True)
+        stats_action.toggled.connect(model.set_stats_visible)
+        self.tree_view.addAction(stats_action)
+        follow_action = QtGui.QAction("Follow SWMR Writes", self.tree_view)
+        follow_action.setCheckable(True)
+        follow_action.toggled.connect(self.set_follow)
+        self.tree_view.addAction(follow_action)
+        self.follow_action = follow_action
         layout.addWidget(self.tree_view)
         self.search_box = QtGui.QLineEdit()
         layout.addWidget(self.search_box)
-        self.search_box.textChanged.connect(match_model.set_match_term)
+        self.status_label = QtGui.QLabel()
+        layout.addWidget(self.status_label)
+
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(self.search_delay)
+        self.search_timer.timeout.connect(self.start_search)
+        self.search_box.textChanged.connect(lambda _: self.search_timer.start())
+        # A new file is searched again, listing its names in the background
+        model.modelReset.connect(self.search_timer.start)
+
+    def set_follow(self, follow):
+        try:
+            self.match_model.sourceModel().set_follow(follow)
+        except (IOError, OSError) as error:
+            self.follow_action.setChecked(False)
+            self.status_label.setText("Cannot follow: %s" % error)
 
+    def start_search(self):
+        term = str(self.search_box.text())
+        generation = self.match_model.sourceModel().search_index.generation
+        # A newer search supersedes one still running
+        future = shared_executor().submit(self.match_model.compute_matches, (term,), priority=1, key=(self, 'search'))
+        def finished(result):
+            count, matches, hits = result
+            self.match_model.apply_matches(term, matches, generation, hits)
+            self.status_label.setText("%d matches" % count if term.strip() else "")
+        future.finished.connect(finished)
+        future.failed.connect(lambda error: self.status_label.setText("Search failed: %s" % error))
+        self.status_label.setText("Searching...")
@@ -1,12 +1,12 @@
 import os
-import h5py
 import sys
-from dataserver import dataserver_helpers
-from h5_widgets import H5File, H5View
+from h5_widgets import H5File, H5View, file_pool
+from lazy_import import LazyModule
 from PyQt4.QtGui import QWidget, QGridLayout, QGroupBox, QDoubleSpinBox, QValidator, QSpinBox, QHBoxLayout, QLabel, \
     QVBoxLayout, QPushButton, QApplication, QLineEdit, QFileDialog, QDialog, QAbstractItemView, QDialogButtonBox, \
     QFormLayout, QSizePolicy
 import numpy as np
+dataserver_helpers = LazyModule('dataserver.dataserver_helpers')
 
 
 class Labelled(QWidget):
@@ -140,7 +140,7 @@ class H5FileWidget(FileWidget):
     def set_dataset(self):
         dialog = QDialog()
         layout = QVBoxLayout(dialog)
-        model = H5File(h5py.File(self.get_path()))
+        model = H5File(file_pool.get(self.get_path()))
         tree_view = H5View()
         tree_view.setModel(model)
         tree_view.setSelectionMode(QAbstractItemView.SingleSelection)
@@ -149,11 +149,11 @@ class H5FileWidget(FileWidget):
         button_box.rejected.connect(dialog.reject)
         layout.addWidget(tree_view)
         layout.addWidget(button_box)
-        if dialog.exec_():
+        if dialog.exec_() and tree_view.selected_path():
             self.dataset_edit.setText(tree_view.selected_path()[1:])
 
     def get_file(self):
-        f = h5py.File(self.get_path())
+        f = file_pool.get(self.get_path())
         return dataserver_helpers.resolve_path(f, str(self.dataset_edit.text()))
 
 
@@ -0,0 +1,36 @@
+import importlib
+import subprocess
+import sys
+
+
+class LazyModule(object):
+    """Stands in for a module that is only imported when one of its attributes is first used"""
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+
+def load_object(path):
+    """The object named by a dotted path such as 'plot_widgets.CrosshairPlotWidget', importing its module"""
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def import_time(module, repeat=3):
+    """Best of repeat times in seconds to import module in a fresh interpreter"""
+    code = 'import time; t = time.time(); import %s; print(time.time() - t)' % module
+    return min(float(subprocess.check_output([sys.executable, '-c', code]).split()[-1]) for _ in range(repeat))
+
+
+def import_times(modules=('settings_window', 'tasks', 'async_loop', 'h5_widgets', 'input_widgets', 'plot_widgets'), repeat=3):
+    return dict((module, import_time(module, repeat)) for module in modules)
+
+
+if __name__ == '__main__':
+    for module, seconds in sorted(import_times().items()):
+        print('%-16s %6.3f s' % (module, seconds))
@@ -0,0 +1,484 @@
+import numbers
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+def is_lazy_array(data):
+    """Whether data is read on indexing, like an h5py.Dataset, rather than held in memory"""
+    return (not isinstance(data, np.ndarray) and hasattr(data, 'shape')
+            and hasattr(data, 'dtype') and hasattr(data, '__getitem__'))
+
+
+def read_blocks(data, block_len, chunk_len=None):
+    """Consecutive slices of data along its first axis, of about block_len items
+    and a multiple of chunk_len long"""
+    if chunk_len:
+        block_len = max(chunk_len, block_len // chunk_len * chunk_len)
+    for start in range(0, len(data), block_len):
+        yield np.asarray(data[start:start + block_len])
+
+
+class GridPointIndex(object):
+    """Bucket grid over a set of 2D points for nearest-point queries with per query
+    distance weights, e.g. to measure distance in screen units"""
+    points_per_cell = 64
+
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        self.size = len(finite)
+        if not self.size:
+            return
+        px, py = x[finite], y[finite]
+        self.x0, self.y0 = px.min(), py.min()
+        self.n = n = max(1, int(np.sqrt(self.size / float(self.points_per_cell))))
+        self.cw = (px.max() - self.x0) / n or 1.
+        self.ch = (py.max() - self.y0) / n or 1.
+        ix = np.clip(((px - self.x0) / self.cw).astype(int), 0, n - 1)
+        iy = np.clip(((py - self.y0) / self.ch).astype(int), 0, n - 1)
+        cells = ix * n + iy
+        order = np.argsort(cells, kind='mergesort')
+        cells = cells[order]
+        self.indices = finite[order]
+        self.px, self.py = px[order], py[order]
+        # Only occupied cells are kept: their bounds and point ranges
+        first = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        self.lo = first
+        self.hi = np.append(first[1:], len(cells))
+        occupied = cells[first]
+        self.cell_x0 = self.x0 + (occupied // n) * self.cw
+        self.cell_y0 = self.y0 + (occupied % n) * self.ch
+
+    def _points(self, cells):
+        lo, hi = self.lo[cells], self.hi[cells]
+        counts = hi - lo
+        # Flatten the [lo, hi) ranges of all cells into one index array
+        return np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    def _nearest_of(self, points, qx, qy, wx, wy):
+        dist = ((self.px[points] - qx)*wx)**2 + ((self.py[points] - qy)*wy)**2
+        i = dist.argmin()
+        return points[i], dist[i]
+
+    def nearest(self, qx, qy, wx=1., wy=1.):
+        """Index of the point nearest (qx, qy) with distance
+        ((x-qx)*wx)**2 + ((y-qy)*wy)**2, or None if there are no points"""
+        if not self.size:
+            return None
+        dx = np.maximum(np.maximum(self.cell_x0 - qx, qx - self.cell_x0 - self.cw), 0) * wx
+        dy = np.maximum(np.maximum(self.cell_y0 - qy, qy - self.cell_y0 - self.ch), 0) * wy
+        bound = dx*dx + dy*dy
+        _, best_dist = self._nearest_of(self._points([bound.argmin()]), qx, qy, wx, wy)
+        best, _ = self._nearest_of(self._points(np.flatnonzero(bound <= best_dist)), qx, qy, wx, wy)
+        return int(self.indices[best])
+
+
+class CurveStack(object):
+    """Many curves, each sorted by x and shifted onto its own stretch of one key axis,
+    so a single searchsorted finds the nearest point of every curve"""
+    def __init__(self):
+        self.keys = []
+        self.sources = []
+        self.bounds = None
+        self.xs = self.ys = self.skeys = np.zeros(0)
+        self.order = np.zeros(0, dtype=int)
+        self.starts = np.zeros(1, dtype=int)
+
+    def _prepare(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        order = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        x = x[order]
+        if len(x) > 1 and (x[1:] < x[:-1]).any():
+            resort = np.argsort(x, kind='mergesort')
+            x, order = x[resort], order[resort]
+        return x, y[order], order
+
+    def _shift(self, x, curve):
+        x0, span = self.bounds
+        return (x - x0) + curve * (2*span + 1)
+
+    def sync(self, curves):
+        """Match the stack to a list of (key, x, y), only touching curves that changed"""
+        wanted = dict((key, (x, y)) for key, x, y in curves)
+        for key, (x, y) in list(zip(self.keys, self.sources)):
+            if key not in wanted or wanted[key][0] is not x or wanted[key][1] is not y:
+                self.remove(key)
+        present = set(self.keys)
+        self.extend([c for c in curves if c[0] not in present])
+
+    def add(self, key, x, y):
+        self.extend([(key, x, y)])
+
+    def extend(self, curves):
+        if not curves:
+            return
+        prepared = [self._prepare(x, y) for _, x, y in curves]
+        first = len(self.keys)
+        self.keys.extend(key for key, _, _ in curves)
+        self.sources.extend((x, y) for _, x, y in curves)
+        filled = [px for px, _, _ in prepared if len(px)]
+        if filled:
+            lo = min(px[0] for px in filled)
+            hi = max(px[-1] for px in filled)
+            if self.bounds is None or lo < self.bounds[0] or hi > self.bounds[0] + self.bounds[1]:
+                if self.bounds is not None:
+                    lo = min(lo, self.bounds[0])
+                    hi = max(hi, self.bounds[0] + self.bounds[1])
+                self.bounds = lo, hi - lo
+                self.skeys = self._shift(self.xs, np.repeat(np.arange(first), np.diff(self.starts)))
+        lengths = [len(px) for px, _, _ in prepared]
+        self.xs = np.concatenate([self.xs] + [px for px, _, _ in prepared])
+        self.ys = np.concatenate([self.ys] + [py for _, py, _ in prepared])
+        self.order = np.concatenate([self.order] + [order for _, _, order in prepared])
+        self.starts = np.append(self.starts, self.starts[-1] + np.cumsum(lengths))
+        if filled:
+            curve = np.repeat(np.arange(first, len(self.keys)), lengths)
+            self.skeys = np.concatenate([self.skeys, self._shift(self.xs[self.starts[first]:], curve)])
+
+    def remove(self, key):
+        c = self.keys.index(key)
+        lo, hi = self.starts[c], self.starts[c + 1]
+        del self.keys[c], self.sources[c]
+        keep = np.r_[0:lo, hi:len(self.xs)]
+        self.xs, self.ys, self.order = self.xs[keep], self.ys[keep], self.order[keep]
+        self.skeys = self.skeys[keep]
+        if self.bounds is not None:
+            # Later curves move down one stretch of the key axis
+            self.skeys[lo:] -= 2*self.bounds[1] + 1
+        self.starts = np.delete(self.starts, c + 1)
+        self.starts[c + 1:] -= hi - lo
+        if not self.keys:
+            self.bounds = None
+
+    def nearest(self, qx, qy, wx=1., wy=1.):
+        """(key, index) of the sample nearest in x to qx on each curve that is
+        closest to (qx, qy), or None if the stack is empty"""
+        lo, hi = self.starts[:-1], self.starts[1:]
+        filled = np.flatnonzero(hi > lo)
+        if not len(filled):
+            return None
+        lo, hi = lo[filled], hi[filled]
+        x0, span = self.bounds
+        q = self._shift(min(max(qx, x0), x0 + span), filled)
+        right = np.clip(np.searchsorted(self.skeys, q), lo, hi - 1)
+        left = np.maximum(right - 1, lo)
+        pick = np.where(np.abs(self.xs[left] - qx) <= np.abs(self.xs[right] - qx), left, right)
+        dist = ((self.xs[pick] - qx)*wx)**2 + ((self.ys[pick] - qy)*wy)**2
+        best = dist.argmin()
+        return self.keys[filled[best]], int(self.order[pick[best]])
+
+
+class MinMaxPyramid(object):
+    """Min/max envelopes of a long trace at successively coarser block sizes, so that
+    drawing cost depends on the display width rather than the trace length"""
+    base_block = 16
+    factor = 4
+    cache_size = 8
+    # Samples read at a time when y is a lazy array
+    read_size = 2**20
+
+    def __init__(self, y, x=None):
+        # A lazy y is read once in chunks to build the levels; raw samples are read as shown
+        self.y = y if is_lazy_array(y) else np.asarray(y)
+        self.x = None if x is None else np.asarray(x)
+        self.levels = []
+        block, lo, hi = self.base_block, self.y, self.y
+        n = len(self.y)
+        if n > block and is_lazy_array(self.y):
+            chunks = getattr(self.y, 'chunks', None)
+            read_len = self.read_size // block * block
+            blocks = [self.reduce(part, block) for part in read_blocks(self.y, read_len, chunks and chunks[0] * block)]
+            lo, hi = np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks])
+            self.levels.append((block, lo, hi))
+            block *= self.factor
+        while n > block:
+            lo, hi = self.reduce(lo, block if not self.levels else self.factor, hi)
+            self.levels.append((block, lo, hi))
+            block *= self.factor
+        self.cache = OrderedDict()
+
+    @staticmethod
+    def reduce(lo, block, hi=None):
+        starts = np.arange(0, len(lo), block)
+        return np.fmin.reduceat(lo, starts), np.fmax.reduceat(lo if hi is None else hi, starts)
+
+    def __len__(self):
+        return len(self.y)
+
+    def index_range(self, x0, x1):
+        if self.x is None:
+            i0, i1 = int(np.floor(x0)), int(np.ceil(x1)) + 1
+        else:
+            i0, i1 = np.searchsorted(self.x, [x0, x1])
+            i0, i1 = int(i0) - 1, int(i1) + 1
+        return max(i0, 0), min(i1, len(self.y))
+
+    def nearest_index(self, x):
+        if self.x is None:
+            return int(np.clip(round(x), 0, len(self.y) - 1))
+        i = int(np.clip(np.searchsorted(self.x, x), 0, len(self.x) - 1))
+        if i and self.x[i] - x > x - self.x[i - 1]:
+            i -= 1
+        return i
+
+    def point(self, i):
+        return (i if self.x is None else self.x[i]), self.y[i]
+
+    def _x(self, indices):
+        return indices.astype(float) if self.x is None else self.x[indices]
+
+    def envelope(self, x0, x1, max_points):
+        """(x, y) to draw for the x-range [x0, x1] using at most about 2*max_points samples"""
+        i0, i1 = self.index_range(x0, x1)
+        # Snap to a coarse grid with a margin so that small pans reuse the cached slice
+        n = max(i1 - i0, 1)
+        level, block = None, 1
+        if n > 2 * max_points:
+            for level, (block, _, _) in enumerate(self.levels):
+                if n // block <= max_points:
+                    break
+        step = block * max(1, n // (4 * block))
+        i0 = max((i0 // step - 1) * step, 0)
+        i1 = min((-(-i1 // step) + 1) * step, len(self.y))
+        key = level, i0, i1
+        if key in self.cache:
+            self.cache[key] = self.cache.pop(key)
+            return self.cache[key]
+        if level is None:
+            result = self._x(np.arange(i0, i1)), self.y[i0:i1]
+        else:
+            _, lo, hi = self.levels[level]
+            b0, b1 = i0 // block, -(-i1 // block)
+            ys = np.empty(2 * (b1 - b0), dtype=lo.dtype)
+            ys[0::2], ys[1::2] = lo[b0:b1], hi[b0:b1]
+            result = np.repeat(self._x(np.arange(b0, b1) * block), 2), ys
+        self.cache[key] = result
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+
+class RingBuffer(object):
+    """Fixed capacity buffer of the most recent (x, y) samples, stored twice so they are
+    always available in order as a contiguous view"""
+    def __init__(self, capacity, dtype=float):
+        self.capacity = capacity
+        self.x = np.empty(2 * capacity, dtype=float)
+        self.y = np.empty(2 * capacity, dtype=dtype)
+        self.start = 0
+        self.count = 0
+        self.total = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, y, x=None):
+        y = np.atleast_1d(np.asarray(y))
+        if x is None:
+            x = np.arange(self.total, self.total + len(y))
+        x = np.atleast_1d(np.asarray(x))
+        self.total += len(y)
+        end = self.start + self.count + len(y)
+        x, y = x[-self.capacity:], y[-self.capacity:]
+        positions = (end - len(y) + np.arange(len(y))) % self.capacity
+        for buf, values in ((self.x, x), (self.y, y)):
+            buf[positions] = values
+            buf[positions + self.capacity] = values
+        self.count = min(self.count + len(y), self.capacity)
+        self.start = (end - self.count) % self.capacity
+
+    def data(self):
+        """Views of the buffered x and y samples, oldest first"""
+        sl = slice(self.start, self.start + self.count)
+        return self.x[sl], self.y[sl]
+
+
+class ImagePyramid(object):
+    """A 2D image together with successively 2x2 averaged copies of it, down to one tile"""
+    tile_size = 512
+    block_rows = 1024
+
+    def __init__(self, image):
+        self.levels = [image]
+        while max(self.levels[-1].shape) > self.tile_size:
+            self.levels.append(self.downsample(self.levels[-1]))
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    @property
+    def level_count(self):
+        return len(self.levels)
+
+    def downsample(self, image):
+        nx, ny = image.shape[0] // 2, image.shape[1] // 2
+        out = np.empty((max(nx, 1), max(ny, 1)), dtype=np.float32)
+        if not nx or not ny:
+            out[...] = image[:2*nx or 1:2, :2*ny or 1:2]
+            return out
+        for i in range(0, nx, self.block_rows):
+            rows = image[2*i:2*min(i + self.block_rows, nx), :2*ny].astype(np.float32)
+            out[i:i + self.block_rows] = (rows[0::2, 0::2] + rows[1::2, 0::2] + rows[0::2, 1::2] + rows[1::2, 1::2]) / 4
+        return out
+
+    def level_shape(self, level):
+        return self.levels[level].shape
+
+    def window(self, level, x0, x1, y0, y1):
+        """The region [x0:x1, y0:y1] of a level, in that level's pixel coordinates"""
+        return self.levels[level][x0:x1, y0:y1]
+
+
+class LazyArray(object):
+    """A 2D h5py.Dataset or similar array read in chunk aligned blocks as it is displayed,
+    with the interface of ImagePyramid.window; level n takes every 2**n-th pixel.
+    window may be called from worker threads."""
+    tile_size = 512
+    block_size = 256
+    cache_bytes = 2**27
+    max_band_bytes = 2**24
+    cache_bands = 8
+
+    def __init__(self, source):
+        self.source = source
+        self.shape = tuple(source.shape)
+        self.dtype = np.dtype(source.dtype)
+        self.ndim = len(self.shape)
+        chunks = getattr(source, 'chunks', None) or (1,) * self.ndim
+        self.block_shape = tuple(max(c, self.block_size // c * c) for c in chunks)
+        block_bytes = self.block_shape[0] * self.block_shape[1] * self.dtype.itemsize
+        self.cache = LRUCache(max(16, self.cache_bytes // block_bytes))
+        self.cache_lock = threading.Lock()
+        self.bands = LRUCache(self.cache_bands)
+        self.level_count = 1
+        while max(self.level_shape(self.level_count - 1)) > self.tile_size:
+            self.level_count += 1
+
+    def __len__(self):
+        return self.shape[0]
+
+    def level_shape(self, level):
+        f = 2 ** level
+        return tuple(-(-n // f) for n in self.shape)
+
+    def block(self, level, i, j):
+        key = level, i, j
+        with self.cache_lock:
+            block = self.cache.get(key)
+        if block is None:
+            f = 2 ** level
+            bx, by = self.block_shape
+            block = np.asarray(self.source[i*bx*f:min((i + 1)*bx*f, self.shape[0]):f,
+                                           j*by*f:min((j + 1)*by*f, self.shape[1]):f])
+            with self.cache_lock:
+                self.cache[key] = block
+        return block
+
+    def window(self, level, x0, x1, y0, y1):
+        """The region [x0:x1, y0:y1] of a level, in that level's pixel coordinates"""
+        nx, ny = self.level_shape(level)
+        x0, x1, y0, y1 = max(x0, 0), min(x1, nx), max(y0, 0), min(y1, ny)
+        out = np.empty((max(x1 - x0, 0), max(y1 - y0, 0)), dtype=self.dtype)
+        bx, by = self.block_shape
+        for i in range(x0 // bx, -(-x1 // bx)):
+            for j in range(y0 // by, -(-y1 // by)):
+                block = self.block(level, i, j)
+                ax0, ax1 = max(x0, i * bx), min(x1, (i + 1) * bx)
+                ay0, ay1 = max(y0, j * by), min(y1, (j + 1) * by)
+                out[ax0 - x0:ax1 - x0, ay0 - y0:ay1 - y0] = block[ax0 - i*bx:ax1 - i*bx, ay0 - j*by:ay1 - j*by]
+        return out
+
+    def preview(self, size=None):
+        """The whole image at the first level no larger than size (tile_size by default) along each axis"""
+        size = size or self.tile_size
+        level = 0
+        while max(self.level_shape(level)) > size:
+            level += 1
+        nx, ny = self.level_shape(level)
+        return level, self.window(level, 0, nx, 0, ny)
+
+    def line(self, axis, index):
+        """The values at index along axis, e.g. line(1, y) is image[:, y], read with the band of chunks around it"""
+        width = self.block_shape[axis]
+        if width * self.shape[1 - axis] * self.dtype.itemsize > self.max_band_bytes:
+            width = 1
+        start = index // width * width
+        key = axis, start, width
+        band = self.bands.get(key)
+        if band is None:
+            band_slice = slice(start, start + width)
+            band = np.asarray(self.source[:, band_slice] if axis else self.source[band_slice, :])
+            self.bands[key] = band
+        return band.take(index - start, axis=axis)
+
+    def __getitem__(self, key):
+        """Rows, columns and single values are served from cached bands; anything else is read directly"""
+        if not isinstance(key, tuple):
+            key = key, slice(None)
+        if len(key) == 2:
+            x, y = key
+            x_all = isinstance(x, slice) and x == slice(None)
+            y_all = isinstance(y, slice) and y == slice(None)
+            if isinstance(y, numbers.Integral) and (x_all or isinstance(x, numbers.Integral)):
+                values = self.line(1, int(y))
+                return values if x_all else values[x]
+            if isinstance(x, numbers.Integral) and y_all:
+                return self.line(0, int(x))
+        return np.asarray(self.source[key])
+
+
+class LRUCache(object):
+    """Mapping that holds at most max_items entries, dropping the least recently used"""
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items[key] = self.items.pop(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+class FrameSource(object):
+    """Frames of a movie read one at a time from an array-like (h5py dataset,
+    memmap, ndarray) or from a callable taking a frame index"""
+    def __init__(self, source, length=None):
+        self.source = source
+        if hasattr(source, '__getitem__'):
+            self.length = len(source) if length is None else length
+        elif length is None:
+            raise ValueError('length is required for callable frame sources')
+        else:
+            self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if hasattr(self.source, '__getitem__'):
+            return np.array(self.source[i])
+        return np.array(self.source(i))
+
+    def read_many(self, indices):
+        return [self[i] for i in indices]
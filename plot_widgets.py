@@ -1,28 +1,157 @@
 from PyQt4 import QtGui, QtCore
+import time
 import warnings
+import weakref
+from collections import OrderedDict, deque
 import numpy as np
 import pyqtgraph as pg
 pg.setConfigOption("useWeave", False)
 from pyqtgraph.dockarea import Dock, DockArea
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg, NavigationToolbar2QTAgg
+from plot_data import (GridPointIndex, CurveStack, MinMaxPyramid, RingBuffer, ImagePyramid, LRUCache, FrameSource,
+                       LazyArray, is_lazy_array)
+from tasks import shared_executor
+
+class EventCoalescer(QtCore.QObject):
+    """Delivers only the latest pending call per handler, at most max_rate times per second
+    (None: on the next pass of the event loop). May be shared between linked widgets."""
+    def __init__(self, max_rate=60, parent=None):
+        super(EventCoalescer, self).__init__(parent)
+        self.max_rate = max_rate
+        self.pending = OrderedDict()
+        self.processed = 0
+        self.dropped = 0
+        self.last_flush = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    def submit(self, handler, *args):
+        if handler in self.pending:
+            self.dropped += 1
+        self.pending[handler] = args
+        if not self.timer.isActive():
+            wait = 0
+            if self.max_rate:
+                wait = self.last_flush + 1. / self.max_rate - time.time()
+            self.timer.start(max(0, int(wait * 1000)))
+
+    def flush(self):
+        self.last_flush = time.time()
+        pending, self.pending = self.pending, OrderedDict()
+        for handler, args in pending.items():
+            handler(*args)
+            self.processed += 1
+
+    def reset_counters(self):
+        self.processed = 0
+        self.dropped = 0
+
 
 class CrosshairPlotWidget(pg.PlotWidget):
     crosshair_moved = QtCore.pyqtSignal(float, float)
+    # 1D traces longer than this are drawn from a min/max envelope pyramid
+    decimation_threshold = 100000
+    # Samples of a lazy trace shown while its pyramid is built
+    preview_points = 4096
+    # Number of samples kept by append_data, and whether the x-range tracks the newest samples
+    history_length = 10000
+    follow = False
     def __init__(self, parametric=False, *args, **kwargs):
+        coalescer = kwargs.pop('mouse_coalescer', None)
         super(CrosshairPlotWidget, self).__init__(*args, **kwargs)
+        self.mouse_coalescer = coalescer or EventCoalescer(parent=self)
         self.scene().sigMouseClicked.connect(self.toggle_search)
-        self.scene().sigMouseMoved.connect(self.handle_mouse_move)
+        self.scene().sigMouseMoved.connect(self.queue_mouse_move)
         self.cross_section_enabled = False
         self.parametric = parametric
         self.search_mode = True
         self.label = None
         self.selected_point = None
+        self.point_indices = weakref.WeakKeyDictionary()
+        self.curve_stack = CurveStack()
+        self.lod = None
+        self.lod_item = None
+        self.lod_shown = None
+        self.stream = None
+        self.stream_item = None
+        vb = self.getPlotItem().getViewBox()
+        vb.sigXRangeChanged.connect(self.update_decimation)
+        vb.sigResized.connect(self.update_decimation)
 
     def set_data(self, data):
         if data is not None and len(data) > 0:
             self.clear()
-            self.plot(data)
+            self.stream = self.stream_item = None
+            if self.decimation_threshold and len(data.shape if is_lazy_array(data) else np.shape(data)) == 1 \
+                    and len(data) > self.decimation_threshold:
+                self.lod = None
+                self.lod_item = self.plot()
+                self.lod_shown = None
+                if is_lazy_array(data):
+                    # Building the pyramid reads the whole trace, so show every stride-th sample meanwhile
+                    stride = -(-len(data) // self.preview_points)
+                    self.lod_item.setData(np.arange(0, len(data), stride), np.asarray(data[::stride]))
+                    self.build_lod(data)
+                else:
+                    self.lod = MinMaxPyramid(data)
+                    self.update_decimation(x_range=(0, len(self.lod)))
+            else:
+                self.lod = self.lod_item = None
+                self.plot(np.asarray(data) if is_lazy_array(data) else data)
+
+    def build_lod(self, data):
+        item = self.lod_item
+        # Replaces a pyramid still being built for a previous trace
+        future = shared_executor().submit(MinMaxPyramid, (data,), key=(self, 'lod'))
+        def finished(lod):
+            if self.lod_item is item:
+                self.lod = lod
+                self.update_decimation()
+        future.finished.connect(finished)
+
+    def append_data(self, y, x=None):
+        """Add samples to a live trace holding the last history_length points.
+        Without x, samples are numbered consecutively from the first one appended."""
+        if self.stream is None or self.stream_item not in self.getPlotItem().items:
+            self.clear()
+            self.lod = self.lod_item = None
+            self.stream = RingBuffer(self.history_length)
+            self.stream_item = self.plot()
+        self.stream.append(y, x)
+        self.update_stream()
+
+    def set_history_length(self, length):
+        self.history_length = length
+        if self.stream is not None:
+            x, y = self.stream.data()
+            total = self.stream.total
+            self.stream = RingBuffer(length, dtype=y.dtype)
+            self.stream.append(y, x)
+            self.stream.total = total
+            self.update_stream()
+
+    def set_follow(self, follow):
+        self.follow = follow
+        if self.stream is not None:
+            self.update_stream()
+
+    def update_stream(self):
+        x, y = self.stream.data()
+        self.stream_item.setData(x, y)
+        if self.follow and len(x):
+            self.setXRange(x[0], x[-1], padding=0)
+
+    def pixel_width(self):
+        return int(self.getPlotItem().getViewBox().width()) or 1000
+
+    def update_decimation(self, *args, **kwargs):
+        if self.lod is None:
+            return
+        min_x, max_x = kwargs.get('x_range') or self.getPlotItem().getViewBox().viewRange()[0]
+        x, y = self.lod.envelope(min_x, max_x, self.pixel_width())
+        if x is not self.lod_shown:
+            self.lod_shown = x
+            self.lod_item.setData(x, y)
 
     def toggle_search(self, mouse_event):
         if mouse_event.double():
@@ -35,26 +164,47 @@ class CrosshairPlotWidget(pg.PlotWidget):
             if self.search_mode:
                 self.handle_mouse_move(mouse_event.scenePos())
 
+    def queue_mouse_move(self, mouse_event):
+        if self.cross_section_enabled and self.search_mode:
+            self.mouse_coalescer.submit(self.handle_mouse_move, QtCore.QPointF(mouse_event))
+
     def handle_mouse_move(self, mouse_event):
         if self.cross_section_enabled and self.search_mode:
             item = self.getPlotItem()
             vb = item.getViewBox()
             view_coords = vb.mapSceneToView(mouse_event)
             view_x, view_y = view_coords.x(), view_coords.y()
+            # Distances are measured in units of the visible range so x and y weigh equally
+            (min_x, max_x), (min_y, max_y) = vb.viewRange()
+            wx, wy = 1. / ((max_x - min_x) or 1.), 1. / ((max_y - min_y) or 1.)
 
             best_guesses = []
+            stacked = []
             for data_item in item.items:
                 if isinstance(data_item, pg.PlotDataItem):
                     xdata, ydata = data_item.xData, data_item.yData
-                    index_distance = lambda i: (xdata[i]-view_x)**2 + (ydata[i] - view_y)**2
-                    if self.parametric:
-                        index = min(range(len(xdata)), key=index_distance)
-                    else:
-                        index = min(np.searchsorted(xdata, view_x), len(xdata)-1)
-                        if index and xdata[index] - view_x > view_x - xdata[index - 1]:
-                            index -= 1
-                    pt_x, pt_y = xdata[index], ydata[index]
-                    best_guesses.append(((pt_x, pt_y), index_distance(index)))
+                    if xdata is None or not len(xdata):
+                        continue
+                    if data_item is self.lod_item:
+                        # Snap to the full resolution trace rather than its envelope
+                        pt_x, pt_y = self.lod.point(self.lod.nearest_index(view_x))
+                        best_guesses.append(((pt_x, pt_y), ((pt_x-view_x)*wx)**2 + ((pt_y-view_y)*wy)**2))
+                        continue
+                    if not self.parametric:
+                        stacked.append((data_item, xdata, ydata))
+                        continue
+                    index = self.point_index(data_item).nearest(view_x, view_y, wx, wy)
+                    if index is not None:
+                        pt_x, pt_y = xdata[index], ydata[index]
+                        best_guesses.append(((pt_x, pt_y), ((pt_x-view_x)*wx)**2 + ((pt_y-view_y)*wy)**2))
+
+            # Also when empty, so that removed curves are dropped from the stack
+            self.curve_stack.sync(stacked)
+            nearest = self.curve_stack.nearest(view_x, view_y, wx, wy)
+            if nearest is not None:
+                data_item, index = nearest
+                pt_x, pt_y = data_item.xData[index], data_item.yData[index]
+                best_guesses.append(((pt_x, pt_y), ((pt_x-view_x)*wx)**2 + ((pt_y-view_y)*wy)**2))
 
             if not best_guesses:
                 return
@@ -66,6 +216,13 @@ class CrosshairPlotWidget(pg.PlotWidget):
             self.label.setText("x=%.2e, y=%.2e" % (pt_x, pt_y))
             self.crosshair_moved.emit(pt_x, pt_y)
 
+    def point_index(self, data_item):
+        """Spatial index of a curve's points, rebuilt whenever its data arrays are replaced"""
+        index = self.point_indices.get(data_item)
+        if index is None or index.x is not data_item.xData or index.y is not data_item.yData:
+            index = self.point_indices[data_item] = GridPointIndex(data_item.xData, data_item.yData)
+        return index
+
     def add_cross_hair(self):
         self.h_line = pg.InfiniteLine(angle=0, movable=False)
         self.v_line = pg.InfiniteLine(angle=90, movable=False)
@@ -84,10 +241,44 @@ class CrosshairPlotWidget(pg.PlotWidget):
         self.cross_section_enabled = False
 
 
+class IncrementalImageItem(pg.ImageItem):
+    """ImageItem that can redraw a rectangular region of its image without rendering the rest"""
+    def render_region(self, x0, x1, y0, y1):
+        argb = getattr(self.qimage, 'data', None)
+        if argb is None or argb.shape[:2] != self.image.shape[1::-1]:
+            # Nothing rendered yet, or rendered at a different resolution
+            self.qimage = None
+        else:
+            lut = self.lut(self.image) if callable(self.lut) else self.lut
+            block = self.image[x0:x1, y0:y1]
+            region, _ = pg.functions.makeARGB(block.transpose((1, 0, 2)[:block.ndim]), lut=lut, levels=self.levels)
+            argb[y0:y1, x0:x1] = region
+        self.update()
+
+
 class CrossSectionImageView(pg.ImageView):
+    """Image view with row and column profiles. 2D h5py datasets and other lazy
+    arrays are wrapped in a LazyArray and only the shown part is read."""
+    # 2D images with more pixels than this are drawn from an ImagePyramid; None disables it
+    pyramid_threshold = None
+    preview_size = 1024
+
     def __init__(self, trace_size=80, **kwargs):
         kwargs['view'] = pg.PlotItem(labels=kwargs.pop('labels', None))
+        kwargs.setdefault('imageItem', IncrementalImageItem())
+        coalescer = kwargs.pop('mouse_coalescer', None)
         super(CrossSectionImageView, self).__init__(**kwargs)
+        self.mouse_coalescer = coalescer or EventCoalescer(parent=self)
+        self.levels_frozen = False
+        self.data_levels = None
+        self.axes_cache = None
+        self.h_profile_index = None
+        self.v_profile_index = None
+        self.marker_index = None
+        self.full_image = None
+        self.pyramid = None
+        self.pyramid_view = None
+        self.pyramid_job = None
         self.view.setAspectLocked(lock=False)
         self.search_mode = False
         self.signals_connected = False
@@ -105,14 +296,14 @@ class CrossSectionImageView(pg.ImageView):
 
         self.y_cross_index = 0
         self.x_cross_index = 0
-        self.h_cross_section_widget = CrosshairPlotWidget()
+        self.h_cross_section_widget = CrosshairPlotWidget(mouse_coalescer=self.mouse_coalescer)
         self.h_cross_section_widget.add_cross_hair()
         self.h_cross_section_widget.search_mode = False
         self.h_cross_section_widget_data = self.h_cross_section_widget.plot([0,0])
         self.h_line = pg.InfiniteLine(pos=0, angle=0, movable=False)
         self.view.addItem(self.h_line, ignoreBounds=False)
 
-        self.v_cross_section_widget = CrosshairPlotWidget()
+        self.v_cross_section_widget = CrosshairPlotWidget(mouse_coalescer=self.mouse_coalescer)
         self.v_cross_section_widget.add_cross_hair()
         self.v_cross_section_widget.search_mode = False
         self.v_cross_section_widget_data = self.v_cross_section_widget.plot([0,0])
@@ -121,6 +312,7 @@ class CrossSectionImageView(pg.ImageView):
 
         self.h_cross_section_widget.crosshair_moved.connect(lambda x, _: self.set_position(x=x))
         self.v_cross_section_widget.crosshair_moved.connect(lambda y, _: self.set_position(y=y))
+        self.view.getViewBox().sigRangeChanged.connect(self.update_pyramid_view)
 
     def set_data(self, data):
         self.setImage(data)
@@ -150,8 +342,145 @@ class CrossSectionImageView(pg.ImageView):
         self.h_line.setPos(mid_y)
         self.v_line.setPos(mid_x)
 
+        self.axes_cache = None
+        image = args[0] if args else kwargs.get('img')
+        self.full_image = self.pyramid = self.pyramid_view = None
+        if is_lazy_array(image) and len(image.shape) != 2:
+            image = np.asarray(image)
+            args = (image,) + tuple(args[1:])
+        if is_lazy_array(image):
+            # Show the coarsest level now, update_pyramid_view reads the rest as it comes into view
+            lazy = image if isinstance(image, LazyArray) else LazyArray(image)
+            self.full_image = self.pyramid = lazy
+            level, preview = lazy.preview()
+            args = (preview,) + tuple(args[1:])
+            kwargs.pop('img', None)
+            kwargs['scale'] = self._xscale * 2 ** level, self._yscale * 2 ** level
+        elif self.pyramid_threshold is not None and np.ndim(image) == 2 and image.size > self.pyramid_threshold:
+            # Show a strided preview now and switch to viewport rendering once the pyramid is built
+            self.full_image = image
+            stride = int(np.ceil(max(image.shape) / float(self.preview_size)))
+            args = (image[::stride, ::stride],) + tuple(args[1:])
+            kwargs.pop('img', None)
+            kwargs['scale'] = self._xscale * stride, self._yscale * stride
+            self.build_pyramid(image)
         super(CrossSectionImageView, self).setImage(*args, **kwargs)
-        self.update_cross_section()
+        self.image_changed()
+
+    def build_pyramid(self, image):
+        # Replaces a pyramid still being built for a previous image
+        future = self.pyramid_job = shared_executor().submit(ImagePyramid, (image,), key=(self, 'pyramid'))
+        def finished(pyramid):
+            if self.full_image is image:
+                self.pyramid = pyramid
+                self.update_pyramid_view()
+            if self.pyramid_job is future:
+                self.pyramid_job = None
+        future.finished.connect(finished)
+
+    def update_pyramid_view(self):
+        """Show the pyramid level matching the screen resolution, cut to the tiles in view"""
+        if self.pyramid is None:
+            return
+        vb = self.view.getViewBox()
+        (min_x, max_x), (min_y, max_y) = vb.viewRange()
+        x0, y0 = self.view_to_index(min_x, min_y)
+        x1, y1 = self.view_to_index(max_x, max_y)
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        density = max((x1 - x0) / (vb.width() or 1.), (y1 - y0) / (vb.height() or 1.))
+        level = int(np.clip(np.floor(np.log2(max(density, 1))), 0, self.pyramid.level_count - 1))
+        factor = 2 ** level
+        tile = self.pyramid.tile_size
+        nx, ny = self.pyramid.level_shape(level)
+        lx0, ly0 = [max(int(v // factor) // tile * tile, 0) for v in (x0, y0)]
+        lx1 = min((int(x1 // factor) // tile + 1) * tile, nx)
+        ly1 = min((int(y1 // factor) // tile + 1) * tile, ny)
+        view = level, lx0, lx1, ly0, ly1
+        if lx1 <= lx0 or ly1 <= ly0 or view == self.pyramid_view:
+            return
+        self.pyramid_view = view
+        pyramid = self.pyramid
+        if not isinstance(pyramid, LazyArray):
+            self.show_window(pyramid.window(*view), view)
+            return
+        # Read from the file in the background; a newer view replaces a read still queued
+        future = shared_executor().submit(pyramid.window, view, key=(self, 'window'))
+        def finished(window):
+            if self.pyramid is pyramid and self.pyramid_view == view:
+                self.show_window(window, view)
+        future.finished.connect(finished)
+
+    def show_window(self, window, view):
+        level, lx0, lx1, ly0, ly1 = view
+        self.imageItem.setImage(window, autoLevels=False)
+        xscale, yscale = self._xscale * 2 ** level, self._yscale * 2 ** level
+        self.imageItem.setRect(QtCore.QRectF(self._x0 + lx0 * xscale, self._y0 + ly0 * yscale,
+                                             (lx1 - lx0) * xscale, (ly1 - ly0) * yscale))
+
+    def updateImage(self, autoHistogramRange=True):
+        if self.pyramid is None or self.pyramid_view is None:
+            return super(CrossSectionImageView, self).updateImage(autoHistogramRange)
+        # The item shows a pyramid window rather than self.image, so redraw the window
+        if autoHistogramRange:
+            self.ui.histogram.setHistogramRange(self.levelMin, self.levelMax)
+        self.pyramid_view = None
+        self.update_pyramid_view()
+
+    def profile_image(self):
+        """The full resolution image that cross sections are taken from"""
+        return self.imageItem.image if self.full_image is None else self.full_image
+
+    def view_to_index(self, x, y):
+        if self.full_image is None:
+            item_coords = self.imageItem.getViewBox().mapFromViewToItem(self.imageItem, QtCore.QPointF(x, y))
+            return item_coords.x(), item_coords.y()
+        return (x - self._x0) / self._xscale, (y - self._y0) / self._yscale
+
+    def allocate_image(self, shape, dtype=float, fill=np.nan, **kwargs):
+        """Show an empty image to be filled in piece by piece with update_image"""
+        kwargs.setdefault('levels', (0, 1))
+        self.data_levels = None
+        self.setImage(np.full(shape, fill, dtype=dtype), autoLevels=False, **kwargs)
+
+    def set_row(self, y, values):
+        self.update_image(np.asarray(values)[:, np.newaxis], 0, y)
+
+    def set_column(self, x, values):
+        self.update_image(np.asarray(values)[np.newaxis, :], x, 0)
+
+    def update_image(self, block, x=0, y=0):
+        """Write a 2D block into the image with its corner at index (x, y), redrawing only that region"""
+        if self.image is None:
+            raise RuntimeError('allocate_image must be called before update_image')
+        if self.full_image is not None:
+            raise RuntimeError('update_image is not supported for images drawn from a pyramid')
+        block = np.asarray(block)
+        x1, y1 = x + block.shape[0], y + block.shape[1]
+        self.image[x:x1, y:y1] = block
+        if not np.may_share_memory(self.imageItem.image, self.image):
+            self.imageItem.image[x:x1, y:y1] = block
+
+        redrawn = False
+        if not self.levels_frozen and np.isfinite(block).any():
+            lo, hi = np.nanmin(block), np.nanmax(block)
+            if self.data_levels is not None:
+                lo, hi = min(lo, self.data_levels[0]), max(hi, self.data_levels[1])
+            if (lo, hi) != self.data_levels:
+                self.data_levels = lo, hi
+                self.setLevels(lo, hi)
+                redrawn = True
+        if not redrawn:
+            self.imageItem.render_region(x, x1, y, y1)
+
+        # Profiles only change if the block crosses the cursor
+        h, v = y <= self.y_cross_index < y1, x <= self.x_cross_index < x1
+        if h or v:
+            self.invalidate_cross_section(h=h, v=v)
+            self.update_cross_section()
+
+    def freeze_levels(self, frozen=True):
+        self.levels_frozen = frozen
 
     def set_histogram(self, visible):
         self.ui.histogram.setVisible(visible)
@@ -165,8 +494,8 @@ class CrossSectionImageView(pg.ImageView):
         if self.imageItem.scene() is None:
             raise RuntimeError('Signal can only be connected after it has been embedded in a scene.')
         self.imageItem.scene().sigMouseClicked.connect(self.toggle_search)
-        self.imageItem.scene().sigMouseMoved.connect(self.handle_mouse_move)
-        self.timeLine.sigPositionChanged.connect(self.update_cross_section)
+        self.imageItem.scene().sigMouseMoved.connect(self.queue_mouse_move)
+        self.timeLine.sigPositionChanged.connect(self.image_changed)
         self.signals_connected = True
 
     def toggle_search(self, mouse_event):
@@ -176,6 +505,10 @@ class CrossSectionImageView(pg.ImageView):
         if self.search_mode:
             self.handle_mouse_move(mouse_event.scenePos())
 
+    def queue_mouse_move(self, mouse_event):
+        if self.search_mode:
+            self.mouse_coalescer.submit(self.handle_mouse_move, QtCore.QPointF(mouse_event))
+
     def handle_mouse_move(self, mouse_event):
         if self.search_mode:
             view_coords = self.imageItem.getViewBox().mapSceneToView(mouse_event)
@@ -187,10 +520,8 @@ class CrossSectionImageView(pg.ImageView):
             x = self.v_line.getXPos()
         if y is None:
             y = self.h_line.getYPos()
-        item_coords = self.imageItem.getViewBox().mapFromViewToItem(self.imageItem, QtCore.QPointF(x, y))
-        #item_coords = self.imageItem.mapFromScene(mouse_event)
-        item_x, item_y = item_coords.x(), item_coords.y()
-        max_x, max_y = self.imageItem.image.shape
+        item_x, item_y = self.view_to_index(x, y)
+        max_x, max_y = self.profile_image().shape
         if item_x < 0 or item_x > max_x or item_y < 0 or item_y > max_y:
             return
         self.v_line.setPos(x)
@@ -198,45 +529,245 @@ class CrossSectionImageView(pg.ImageView):
         #(min_view_x, max_view_x), (min_view_y, max_view_y) = self.imageItem.getViewBox().viewRange()
         self.x_cross_index = max(min(int(item_x), max_x-1), 0)
         self.y_cross_index = max(min(int(item_y), max_y-1), 0)
-        z_val = self.imageItem.image[self.x_cross_index, self.y_cross_index]
         self.update_cross_section()
         #self.text_item.setText("x=%.2e, y=%.2e, z=%.2e" % (view_x, view_y, z_val))
 
+    def cross_section_axes(self):
+        shape = self.profile_image().shape
+        if self.axes_cache is None or self.axes_cache[0] != shape:
+            nx, ny = shape
+            x0, y0, xscale, yscale = self._x0, self._y0, self._xscale, self._yscale
+            xdata = np.linspace(x0, x0+(xscale*(nx-1)), nx)
+            ydata = np.linspace(y0, y0+(yscale*(ny-1)), ny)
+            self.axes_cache = shape, xdata, ydata
+        return self.axes_cache[1:]
+
+    def invalidate_cross_section(self, h=True, v=True):
+        """Mark profiles as stale after the image data under them changed"""
+        if h:
+            self.h_profile_index = None
+        if v:
+            self.v_profile_index = None
+        self.marker_index = None
+
+    def image_changed(self):
+        self.invalidate_cross_section()
+        self.update_cross_section()
+
     def update_cross_section(self):
-        nx, ny = self.imageItem.image.shape
-        x0, y0, xscale, yscale = self._x0, self._y0, self._xscale, self._yscale
-        xdata = np.linspace(x0, x0+(xscale*(nx-1)), nx)
-        ydata = np.linspace(y0, y0+(yscale*(ny-1)), ny)
-        zval = self.imageItem.image[self.x_cross_index, self.y_cross_index]
-        self.h_cross_section_widget_data.setData(xdata, self.imageItem.image[:, self.y_cross_index])
-        self.h_cross_section_widget.v_line.setPos(xdata[self.x_cross_index])
+        image = self.profile_image()
+        x_index, y_index = self.x_cross_index, self.y_cross_index
+        update_h = self.h_profile_index != y_index
+        update_v = self.v_profile_index != x_index
+        if image is None or not (update_h or update_v or self.marker_index != (x_index, y_index)):
+            return
+        xdata, ydata = self.cross_section_axes()
+        if update_h:
+            self.h_cross_section_widget_data.setData(xdata, image[:, y_index])
+            self.h_profile_index = y_index
+        if update_v:
+            self.v_cross_section_widget_data.setData(ydata, image[x_index, :])
+            self.v_profile_index = x_index
+        zval = image[x_index, y_index]
+        self.h_cross_section_widget.v_line.setPos(xdata[x_index])
         self.h_cross_section_widget.h_line.setPos(zval)
-        self.v_cross_section_widget_data.setData(ydata, self.imageItem.image[self.x_cross_index, :])
-        self.v_cross_section_widget.v_line.setPos(ydata[self.y_cross_index])
+        self.v_cross_section_widget.v_line.setPos(ydata[y_index])
         self.v_cross_section_widget.h_line.setPos(zval)
+        self.marker_index = x_index, y_index
 
 class MoviePlotWidget(CrossSectionImageView):
+    """Image view of a (t, x, y) movie. Frames not held in memory are read in the background
+    into an LRU cache; the frame to show is read ahead of any prefetching."""
+    cache_frames = 64
+    prefetch_frames = 8
+    # Playback rate in frames per second; cross sections may be refreshed less often while playing
+    fps = 20
+    speed = 1.
+    cross_section_fps = None
+    playback_stats_changed = QtCore.pyqtSignal(float, float, int)
+
     def __init__(self, *args, **kwargs):
         super(MoviePlotWidget, self).__init__(*args, **kwargs)
         self.play_button = QtGui.QPushButton("Play")
         self.stop_button = QtGui.QPushButton("Stop")
         self.stop_button.hide()
         self.play_timer = QtCore.QTimer()
-        self.play_timer.setInterval(50)
-        self.play_timer.timeout.connect(self.increment)
-        self.play_button.clicked.connect(self.play_timer.start)
+        self.play_timer.setInterval(int(1000 / self.fps))
+        self.play_timer.timeout.connect(self.advance)
+        self.play_button.clicked.connect(self.play)
         self.play_button.clicked.connect(self.play_button.hide)
         self.play_button.clicked.connect(self.stop_button.show)
-        self.stop_button.clicked.connect(self.play_timer.stop)
+        self.stop_button.clicked.connect(self.stop)
         self.stop_button.clicked.connect(self.play_button.show)
         self.stop_button.clicked.connect(self.stop_button.hide)
 
+        self.play_start = None
+        self.last_cross_section = 0
+        self.shown_times = deque(maxlen=32)
+        self.achieved_fps = 0.
+        self.render_time = 0.
+        self.dropped_frames = 0
+
+        self.frames = None
+        self.frame_cache = LRUCache(self.cache_frames)
+        self.frame_index = 0
+        self.direction = 1
+        self.wanted_frame = None
+        # Futures of the frame reads in progress, by frame index
+        self.reading = {}
+        self.prefetch_job = None
+        self.frame_slider = QtGui.QSlider(QtCore.Qt.Horizontal)
+        self.frame_slider.hide()
+        self.frame_slider.valueChanged.connect(self.show_frame)
+
     def setImage(self, array, *args, **kwargs):
-        super(MoviePlotWidget, self).setImage(array, *args, **kwargs)
-        self.tpts = len(array)
+        if isinstance(array, np.ndarray) and not isinstance(array, np.memmap):
+            self.frames = None
+            self.frame_slider.hide()
+            super(MoviePlotWidget, self).setImage(array, *args, **kwargs)
+            self.tpts = len(array)
+        else:
+            self.set_frame_source(array, **kwargs)
+
+    def set_frame_source(self, source, length=None, **kwargs):
+        self.frames = FrameSource(source, length)
+        self.tpts = len(self.frames)
+        self.frame_cache.clear()
+        self.wanted_frame = None
+        self.reading = {}
+        self.prefetch_job = None
+        self.frame_index = 0
+        self.frame_cache[0] = self.frames[0]
+        super(MoviePlotWidget, self).setImage(self.frame_cache.get(0), **kwargs)
+        self.frame_slider.blockSignals(True)
+        self.frame_slider.setRange(0, self.tpts - 1)
+        self.frame_slider.setValue(0)
+        self.frame_slider.blockSignals(False)
+        self.frame_slider.show()
+        self.load_frames()
+
+    def show_frame(self, index, direction=None):
+        index %= self.tpts
+        if direction is None:
+            direction = 1 if index >= self.frame_index else -1
+        self.direction = direction
+        self.frame_index = index
+        if self.frame_slider.value() != index:
+            self.frame_slider.blockSignals(True)
+            self.frame_slider.setValue(index)
+            self.frame_slider.blockSignals(False)
+        frame = self.frame_cache.get(index)
+        if frame is None:
+            self.wanted_frame = index
+        else:
+            self.wanted_frame = None
+            self.imageItem.updateImage(frame)
+            self.image_changed()
+        self.load_frames()
+
+    def load_frames(self):
+        """Read the wanted frame right away, and prefetch ahead one frame at a time"""
+        if self.frames is None:
+            return
+        if self.wanted_frame is not None and self.wanted_frame not in self.reading:
+            # Goes ahead of prefetching, and replaces a wanted read that has not started yet
+            self.read_frame(self.wanted_frame, priority=1, key=(self, 'wanted'))
+        if self.prefetch_job is None:
+            ahead = [(self.frame_index + k * self.direction) % self.tpts
+                     for k in range(1, min(self.prefetch_frames, self.cache_frames - 1, self.tpts - 1) + 1)]
+            ahead = [i for i in ahead if i not in self.frame_cache and i not in self.reading]
+            if ahead:
+                self.prefetch_job = self.read_frame(ahead[0])
+
+    def read_frame(self, index, priority=0, key=None):
+        frames = self.frames
+        future = self.reading[index] = shared_executor().submit(frames.__getitem__, (index,), priority, key)
+        def done():
+            if self.reading.get(index) is future:
+                del self.reading[index]
+            if self.prefetch_job is future:
+                self.prefetch_job = None
+        def finished(frame):
+            done()
+            if frames is not self.frames:
+                return
+            self.frame_cache[index] = frame
+            if self.wanted_frame == index:
+                self.show_frame(index, self.direction)
+            else:
+                self.load_frames()
+        def failed(error):
+            done()
+            warnings.warn('Reading frame %d failed: %s' % (index, error))
+        future.finished.connect(finished)
+        future.failed.connect(failed)
+        future.cancelled.connect(done)
+        return future
+
+    def current_frame(self):
+        return self.currentIndex if self.frames is None else self.frame_index
+
+    def go_to_frame(self, index, direction=None):
+        if self.frames is None:
+            self.setCurrentIndex(index % self.tpts)
+        else:
+            self.show_frame(index, direction)
+
+    def play(self):
+        self.play_start = time.time(), self.current_frame()
+        self.shown_times.clear()
+        self.dropped_frames = 0
+        self.play_timer.start()
+
+    def stop(self):
+        self.play_timer.stop()
+        self.update_cross_section()
+
+    def set_fps(self, fps):
+        self.fps = fps
+        self.play_timer.setInterval(int(1000 / fps))
+        if self.play_timer.isActive():
+            self.play_start = time.time(), self.current_frame()
+
+    def set_speed(self, speed):
+        self.speed = speed
+        if self.play_timer.isActive():
+            self.play_start = time.time(), self.current_frame()
+
+    def step(self, frames=1):
+        self.go_to_frame(self.current_frame() + frames, direction=1 if frames >= 0 else -1)
 
     def increment(self):
-        self.setCurrentIndex((self.currentIndex + 1) % self.tpts)
+        self.step(1)
+
+    def advance(self):
+        """Show the frame due at the current wall clock time, skipping any that were missed"""
+        start_time, start_frame = self.play_start
+        now = time.time()
+        target = start_frame + int((now - start_time) * self.fps * self.speed)
+        current = self.current_frame()
+        if target % self.tpts == current:
+            return
+        self.dropped_frames += max(abs(target - current) % self.tpts - 1, 0)
+        self.go_to_frame(target, direction=1 if self.speed >= 0 else -1)
+        if self.imageItem.qimage is None:
+            self.imageItem.render()
+        done = time.time()
+        self.render_time = 0.9 * self.render_time + 0.1 * (done - now) if self.render_time else done - now
+        self.shown_times.append(done)
+        span = self.shown_times[-1] - self.shown_times[0]
+        if span > 0:
+            self.achieved_fps = (len(self.shown_times) - 1) / span
+        self.playback_stats_changed.emit(self.achieved_fps, self.render_time, self.dropped_frames)
+
+    def image_changed(self):
+        self.invalidate_cross_section()
+        if self.cross_section_fps and self.play_timer.isActive():
+            now = time.time()
+            if now - self.last_cross_section < 1. / self.cross_section_fps:
+                return
+            self.last_cross_section = now
+        self.update_cross_section()
 
 
 class CloseableDock(Dock):
@@ -327,9 +858,15 @@ class BackendSwitchableDock(CloseableDock):
         switch_button.raise_()
 
 class MPLPlotWidget(QtGui.QWidget):
+    # Lazy arrays are drawn as the min/max envelope of this many blocks, read in the background
+    preview_points = 2000
+
     def __init__(self):
         super(MPLPlotWidget, self).__init__()
         layout = QtGui.QVBoxLayout(self)
+        # matplotlib is only imported once a matplotlib plot is used
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg, NavigationToolbar2QTAgg
         fig = Figure()
         self.axes = fig.add_subplot(111)
         self.axes.hold(False)
@@ -337,14 +874,37 @@ class MPLPlotWidget(QtGui.QWidget):
         self.navbar = NavigationToolbar2QTAgg(self.canvas, self)
         layout.addWidget(self.canvas)
         layout.addWidget(self.navbar)
+        self.lazy_data = None
         #self.setSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
 
     def set_data(self, data):
-        self.axes.plot(data)
+        self.lazy_data = None
+        if is_lazy_array(data) and len(data.shape) == 1:
+            # Every stride-th sample until the envelope is built
+            stride = max(1, len(data) // self.preview_points)
+            self.axes.plot(np.arange(0, len(data), stride), np.asarray(data[::stride]))
+            self.lazy_data = data
+            future = shared_executor().submit(MinMaxPyramid, (data,), key=(self, 'envelope'))
+            def finished(lod):
+                if self.lazy_data is data:
+                    self.axes.plot(*lod.envelope(0, len(data), self.preview_points))
+                    self.canvas.draw()
+            future.finished.connect(finished)
+        else:
+            self.axes.plot(np.asarray(data) if is_lazy_array(data) else data)
 
 class MPLImageView(MPLPlotWidget):
+    preview_size = 1024
+
     def set_data(self, data):
-        self.axes.imshow(data, interpolation='nearest', aspect='auto')
+        self.lazy_data = None
+        if is_lazy_array(data) and len(data.shape) == 2:
+            lazy = data if isinstance(data, LazyArray) else LazyArray(data)
+            nx, ny = lazy.shape
+            self.axes.imshow(lazy.preview(self.preview_size)[1], interpolation='nearest', aspect='auto',
+                             extent=(-.5, ny - .5, nx - .5, -.5))
+        else:
+            self.axes.imshow(np.asarray(data) if is_lazy_array(data) else data, interpolation='nearest', aspect='auto')
 
 
 class BackendSwitchablePlot(QtGui.QWidget):
@@ -377,6 +937,12 @@ class BackendSwitchableImageView(BackendSwitchablePlot):
     MPLWidget = MPLImageView
     PGWidget = CrossSectionImageView
 
+    def set_data(self, data):
+        if is_lazy_array(data) and len(data.shape) == 2 and not isinstance(data, LazyArray):
+            # Share the blocks read between both backends
+            data = LazyArray(data)
+        super(BackendSwitchableImageView, self).set_data(data)
+
 
 if __name__ == '__main__':
     import sys
@@ -1,12 +1,23 @@
 from PyQt4.QtCore import QObject, pyqtSignal, QThread, Qt
-from PyQt4.QtGui import QApplication, QMainWindow
+from PyQt4.QtGui import QApplication, QMainWindow, QWidget, QVBoxLayout, QDockWidget
 import sys
+from lazy_import import load_object
 
 
-def run(widget_class, settings=None, ui_version=1, **kwargs):
+def run(widget_class, settings=None, ui_version=1, use_asyncio=False, use_processes=False, **kwargs):
+    """Show widget_class(**kwargs) and run the application. With use_asyncio, an
+    asyncio event loop runs inside the Qt one for coroutines started with schedule.
+    With use_processes, the processes of shared_process_executor are started first,
+    as Python 2 can only fork them and forking is unsafe once threads run."""
+    if use_processes:
+        from tasks import shared_process_executor
+        shared_process_executor().warm_up()
     app = QApplication.instance()
     if app is None:
         app = QApplication([])
+    if use_asyncio:
+        from async_loop import install_asyncio
+        install_asyncio()
 
     if settings is not None:
         window = SettingsWindow(settings, ui_version)
@@ -28,9 +39,21 @@ class SettingsWindow(QMainWindow):
         self.ui_version = ui_version
 
     def restore_from_settings(self):
+        """Restore the window layout; docks added with add_lazy_dock are only built once shown"""
         self.restoreGeometry(self.settings.value("geometry").toByteArray())
         self.restoreState(self.settings.value("state").toByteArray(), self.ui_version)
 
+    def add_lazy_dock(self, name, factory, *args, **kwargs):
+        """Add a dock holding a LazyWidget for factory(*args, **kwargs) to the keyword argument
+        dock_area, by default the left one. Call before restore_from_settings so the saved
+        layout can place it by name."""
+        dock_area = kwargs.pop('dock_area', Qt.LeftDockWidgetArea)
+        dock = QDockWidget(name, self)
+        dock.setObjectName(name)
+        dock.setWidget(LazyWidget(factory, *args, **kwargs))
+        self.addDockWidget(dock_area, dock)
+        return dock
+
     def closeEvent(self, ev):
         if self.settings is not None:
             self.settings.setValue("geometry", self.saveGeometry())
@@ -40,6 +63,36 @@ class SettingsWindow(QMainWindow):
         del widget
         return super(SettingsWindow, self).closeEvent(ev)
 
+class LazyWidget(QWidget):
+    """Placeholder that creates its widget from factory, a callable or a dotted path
+    such as 'plot_widgets.CrosshairPlotWidget', the first time it is shown. The keyword
+    argument placeholder_parent is the parent of the placeholder, any other argument
+    goes to factory."""
+    built = pyqtSignal(object)
+
+    def __init__(self, factory, *args, **kwargs):
+        super(LazyWidget, self).__init__(kwargs.pop('placeholder_parent', None))
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+        self.inner = None
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+    def widget(self):
+        """The real widget, created now if it was not shown yet"""
+        if self.inner is None:
+            factory = load_object(self.factory) if isinstance(self.factory, str) else self.factory
+            self.inner = factory(*self.args, **self.kwargs)
+            self.layout().addWidget(self.inner)
+            self.built.emit(self.inner)
+        return self.inner
+
+    def showEvent(self, ev):
+        self.widget()
+        return super(LazyWidget, self).showEvent(ev)
+
+
 class Worker(QObject):
     finished = pyqtSignal(name="finished")
     def __init__(self, *args):
@@ -55,8 +108,7 @@ def run_in_thread(fn, args):
     worker.process = fn
     thread = QThread()
     worker.moveToThread(thread)
-    app = QApplication.instance()
-    app.connect(thread, Qt.SIGNAL('started()'), worker.start)
-    app.connect(worker, Qt.SIGNAL('finished()'), thread.quit)
-    app.connect(worker, Qt.SIGNAL('finished()'), thread.deleteLater)
+    thread.started.connect(worker.start)
+    worker.finished.connect(thread.quit)
+    worker.finished.connect(thread.deleteLater)
     return worker, thread
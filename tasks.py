@@ -0,0 +1,368 @@
+from PyQt4.QtCore import QObject, pyqtSignal, QThreadPool, QRunnable, QTimer
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import traceback
+import warnings
+import numpy as np
+try:
+    from multiprocessing.reduction import ForkingPickler
+except ImportError:
+    # Python 2
+    from multiprocessing.forking import ForkingPickler
+
+
+class Cancelled(Exception):
+    """Raised by check_cancelled in a task whose future was cancelled"""
+
+
+_current = threading.local()
+
+
+def current_task():
+    """The TaskFuture of the task running on this thread, or None"""
+    return getattr(_current, 'future', None)
+
+
+def check_cancelled():
+    """Stop the running task if it was cancelled; call this between steps of long tasks"""
+    future = current_task()
+    if future is not None and future.cancel_requested:
+        raise Cancelled()
+
+
+def report_progress(value):
+    """Emit progress(value) on the GUI thread from the running task"""
+    future = current_task()
+    if future is not None:
+        future.progress_reported.emit(value)
+
+
+class TaskFuture(QObject):
+    """Handle of a submitted task, emitting exactly one of finished(result), failed(exception)
+    or cancelled() on the thread it was created on"""
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    cancelled = pyqtSignal()
+    progress = pyqtSignal(object)
+    # Emitted from the worker thread and relayed by the slots below
+    completed = pyqtSignal(object, object)
+    progress_reported = pyqtSignal(object)
+
+    def __init__(self, fn, args, executor=None, key=None):
+        super(TaskFuture, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.executor = executor
+        self.key = key
+        self.cancel_requested = False
+        self.done = False
+        self.result = None
+        self.error = None
+        self.traceback_text = None
+        self.completed.connect(self.complete)
+        self.progress_reported.connect(self.relay_progress)
+
+    def cancel(self):
+        """Ask the task to stop. One that has not started yet never runs; a running one
+        stops at its next check_cancelled, and its result is discarded in any case."""
+        self.cancel_requested = True
+
+    def run(self):
+        _current.future = self
+        result = error = None
+        try:
+            check_cancelled()
+            result = self.fn(*self.args)
+        except Exception as e:
+            error = e
+            self.traceback_text = traceback.format_exc()
+        finally:
+            _current.future = None
+        self.completed.emit(result, error)
+
+    def relay_progress(self, value):
+        if not self.cancel_requested:
+            self.progress.emit(value)
+
+    def complete(self, result, error):
+        if self.done:
+            return
+        self.done = True
+        if self.executor is not None:
+            self.executor.task_done(self)
+        if self.cancel_requested or isinstance(error, Cancelled):
+            self.cancelled.emit()
+        elif error is not None:
+            self.error = error
+            self.failed.emit(error)
+        else:
+            self.result = result
+            self.finished.emit(result)
+
+
+class TaskRunnable(QRunnable):
+    def __init__(self, future):
+        super(TaskRunnable, self).__init__()
+        self.future = future
+
+    def run(self):
+        self.future.run()
+
+
+class TaskExecutor(QObject):
+    """Runs functions on a bounded pool of reused threads. A task submitted with a key
+    cancels the previous one with the same key, so only the latest result is delivered."""
+    def __init__(self, max_workers=None, parent=None):
+        super(TaskExecutor, self).__init__(parent)
+        self.pool = QThreadPool(self)
+        if max_workers is not None:
+            self.pool.setMaxThreadCount(max_workers)
+        self.running = set()
+        self.latest = {}
+
+    def submit(self, fn, args=(), priority=0, key=None):
+        future = TaskFuture(fn, args, self, key)
+        if key is not None:
+            previous = self.latest.get(key)
+            if previous is not None:
+                previous.cancel()
+            self.latest[key] = future
+        # Keep the future and its runnable alive until the task is over
+        runnable = future.runnable = TaskRunnable(future)
+        runnable.setAutoDelete(False)
+        self.running.add(future)
+        self.pool.start(runnable, priority)
+        return future
+
+    def task_done(self, future):
+        self.running.discard(future)
+        if future.key is not None and self.latest.get(future.key) is future:
+            del self.latest[future.key]
+
+    def cancel_all(self):
+        for future in list(self.running):
+            future.cancel()
+
+    def wait(self, msecs=-1):
+        return self.pool.waitForDone(msecs)
+
+
+_executor = None
+
+
+def shared_executor():
+    """The TaskExecutor used by the widgets of this package, created on first use"""
+    global _executor
+    if _executor is None:
+        _executor = TaskExecutor()
+    return _executor
+
+
+class SharedArray(object):
+    """Picklable reference to an array stored in a memory mapped file"""
+    def __init__(self, array, directory):
+        fd, self.path = tempfile.mkstemp(suffix='.npy', dir=directory)
+        os.close(fd)
+        self.dtype, self.shape = array.dtype.str, array.shape
+        out = np.memmap(self.path, dtype=array.dtype, mode='w+', shape=array.shape)
+        out[...] = array
+        out.flush()
+        del out
+
+    def load(self, mode='c'):
+        return np.memmap(self.path, dtype=np.dtype(self.dtype), mode=mode, shape=self.shape)
+
+
+def share_arrays(value, directory, threshold, created=None):
+    """value with arrays of at least threshold bytes, also inside tuples and lists,
+    moved to SharedArrays, which are added to the list created if given"""
+    if isinstance(value, np.ndarray) and value.nbytes >= threshold and value.dtype != object and value.size:
+        array = SharedArray(value, directory)
+        if created is not None:
+            created.append(array)
+        return array
+    if isinstance(value, (tuple, list)):
+        return type(value)(share_arrays(v, directory, threshold, created) for v in value)
+    return value
+
+
+def load_arrays(value, shared, mode='c'):
+    """Inverse of share_arrays, collecting the SharedArrays found in shared"""
+    if isinstance(value, SharedArray):
+        shared.append(value)
+        return value.load(mode)
+    if isinstance(value, (tuple, list)):
+        return type(value)(load_arrays(v, shared, mode) for v in value)
+    return value
+
+
+def remove_files(shared):
+    for array in shared:
+        try:
+            os.remove(array.path)
+        except OSError:
+            pass
+
+
+def check_picklable(value):
+    """Raise the error the pool would run into sending value to or from a process"""
+    ForkingPickler(io.BytesIO(), pickle.HIGHEST_PROTOCOL).dump(value)
+
+
+def run_shared(fn, args, directory, threshold):
+    """Run fn in a pool process, returning (ok, result or (error text, traceback))"""
+    created = []
+    try:
+        result = share_arrays(fn(*load_arrays(args, [])), directory, threshold, created)
+        # The pool of Python 2 never delivers a result it fails to pickle
+        check_picklable(result)
+        return True, result
+    except Exception as e:
+        remove_files(created)
+        return False, ('%s: %s' % (type(e).__name__, e), traceback.format_exc())
+
+
+class RemoteError(Exception):
+    """An exception raised by a task in a ProcessExecutor process"""
+
+
+class ProcessExecutor(QObject):
+    """TaskExecutor counterpart running picklable functions in worker processes. Large arrays
+    are passed through memory mapped files; running tasks can't be stopped. Python 2 can only
+    fork the processes, which is unsafe once threads run, so there warm_up should be called
+    before any thread starts, e.g. through run(..., use_processes=True)."""
+    shared_threshold = 2**20
+    # ms between checks for worker processes that died, while tasks are running
+    watchdog_interval = 1000
+
+    def __init__(self, processes=None, parent=None):
+        super(ProcessExecutor, self).__init__(parent)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shared_directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.pool = None
+        self.queue = []
+        self.counter = itertools.count()
+        self.active = 0
+        self.running = set()
+        self.latest = {}
+        self.pids = set()
+        self.watchdog = QTimer(self)
+        self.watchdog.setInterval(self.watchdog_interval)
+        self.watchdog.timeout.connect(self.check_workers)
+
+    def warm_up(self):
+        if self.pool is None:
+            # Forking a process with running Qt threads is unsafe, so start fresh interpreters where possible
+            if hasattr(multiprocessing, 'get_context'):
+                context = multiprocessing.get_context('spawn')
+            else:
+                context = multiprocessing
+                if _executor is not None:
+                    warnings.warn('Forking worker processes after the shared TaskExecutor started threads')
+            others = set(p.pid for p in multiprocessing.active_children())
+            self.pool = context.Pool(self.processes)
+            self.pids = set(p.pid for p in multiprocessing.active_children()) - others
+
+    def submit(self, fn, args=(), priority=0, key=None):
+        future = TaskFuture(fn, args, self, key)
+        if key is not None:
+            previous = self.latest.get(key)
+            if previous is not None:
+                previous.cancel()
+            self.latest[key] = future
+        future.shared = []
+        self.running.add(future)
+        heapq.heappush(self.queue, (-priority, next(self.counter), future))
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        self.warm_up()
+        while self.queue and self.active < self.processes:
+            _, _, future = heapq.heappop(self.queue)
+            if future.cancel_requested:
+                future.completed.emit(None, Cancelled())
+                continue
+            args = share_arrays(tuple(future.args), self.shared_directory, self.shared_threshold, future.shared)
+            try:
+                # The pool of Python 2 loses a task it fails to pickle
+                check_picklable((future.fn, args))
+            except Exception as e:
+                self.fail_later(future, e)
+                continue
+            self.active += 1
+            future.dispatched = True
+            kwargs = {}
+            if sys.version_info[0] >= 3:
+                # E.g. arguments or a result that can't be pickled
+                kwargs['error_callback'] = lambda error, future=future: future.completed.emit(None, error)
+            self.pool.apply_async(run_shared, (future.fn, args, self.shared_directory, self.shared_threshold),
+                                  callback=lambda output, future=future: self.task_returned(future, output), **kwargs)
+        if self.active:
+            self.watchdog.start()
+        else:
+            self.watchdog.stop()
+
+    def fail_later(self, future, error):
+        # From the event loop, as submit may not have returned yet to let the caller connect
+        QTimer.singleShot(0, lambda: future.completed.emit(None, error))
+
+    def task_returned(self, future, output):
+        """Called on the pool's result thread"""
+        ok, value = output
+        if ok:
+            future.completed.emit(load_arrays(value, future.shared, 'r+'), None)
+        else:
+            future.traceback_text = value[1]
+            future.completed.emit(None, RemoteError(value[0]))
+
+    def task_done(self, future):
+        self.running.discard(future)
+        if future.key is not None and self.latest.get(future.key) is future:
+            del self.latest[future.key]
+        # Result memmaps stay valid after their files are removed
+        remove_files(future.shared)
+        if getattr(future, 'dispatched', False):
+            self.active -= 1
+            self.dispatch()
+
+    def check_workers(self):
+        """The pool neither reports nor reruns the task of a worker process that
+        died, so fail the tasks in the pool and start it afresh"""
+        if self.pool is None or self.pids <= set(p.pid for p in multiprocessing.active_children()):
+            return
+        self.pool.terminate()
+        self.pool = None
+        for future in list(self.running):
+            if getattr(future, 'dispatched', False) and not future.done:
+                future.completed.emit(None, RemoteError('A worker process died'))
+
+    def cancel_all(self):
+        for future in list(self.running):
+            future.cancel()
+
+    def shutdown(self):
+        self.cancel_all()
+        self.watchdog.stop()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+_process_executor = None
+
+
+def shared_process_executor():
+    """The ProcessExecutor for CPU bound work, created on first use"""
+    global _process_executor
+    if _process_executor is None:
+        _process_executor = ProcessExecutor()
+    return _process_executor
@@ -0,0 +1,45 @@
+import numpy as np
+from plot_data import CurveStack
+
+
+def brute_nearest(curves, qx, qy):
+    best = None
+    for key, x, y in curves:
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        if not len(finite):
+            continue
+        i = finite[np.abs(x[finite] - qx).argmin()]
+        d = (x[i] - qx)**2 + (y[i] - qy)**2
+        if best is None or d < best[0]:
+            best = d, key, i
+    return None if best is None else best[1:]
+
+
+def test_curve_stack_all_nan_curve():
+    cs = CurveStack()
+    cs.sync([('a', [np.nan, np.nan], [1, 2])])
+    assert cs.nearest(0, 0) is None
+    cs.sync([])
+    assert cs.keys == [] and cs.nearest(0, 0) is None
+
+
+def test_curve_stack_empty_and_nan_curves_among_others():
+    a = ('a', np.arange(5.), np.arange(5.))
+    nan = ('nan', np.array([np.nan, np.nan]), np.array([1., 2.]))
+    empty = ('empty', np.zeros(0), np.zeros(0))
+    b = ('b', np.arange(10., 20.), np.ones(10))
+    cs = CurveStack()
+    for curves in ([nan, empty], [nan, empty, a], [a, nan, b], [a, b], [empty, b], [b], []):
+        cs.sync(curves)
+        assert sorted(cs.keys) == sorted(key for key, _, _ in curves)
+        for qx, qy in [(-3, 0), (2.4, 2), (12.6, 1), (30, 5)]:
+            assert cs.nearest(qx, qy) == brute_nearest(curves, qx, qy)
+
+
+def test_curve_stack_skips_nan_y():
+    a = ('a', np.array([1., 2., 3.]), np.array([0., np.nan, 0.]))
+    b = ('b', np.array([2.]), np.array([0.1]))
+    cs = CurveStack()
+    cs.sync([a, b])
+    assert cs.nearest(2, 0) == ('b', 0) == brute_nearest([a, b], 2, 0)